@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''
+Offline benchmark for repowatch
+
+Creates local bare repositories, points a RepoWatch at them through file://
+URLs and sends it synthetic Gerrit stream events and GitLab web hooks at a
+fixed rate. Every event first moves its branch to another commit so the
+workers do a real fetch and checkout. Reports events/sec, end to end latency,
+commands run and disk use.
+
+    python benchmarks/bench_repowatch.py --projects 4 --branches 50 --events 500 --rate 100
+    python benchmarks/bench_repowatch.py --mirror    # shared object store per project
+    python benchmarks/bench_repowatch.py --backend dulwich
+'''
+
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import httplib
+import argparse
+import tempfile
+import threading
+import subprocess
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import repowatch  # noqa: E402
+from repowatch.worker import Worker  # noqa: E402
+from repowatch.reconcile import Trash, TRASH_PREFIX  # noqa: E402
+from repowatch.eventqueue import CoalescingQueue  # noqa: E402
+from repowatch.gitlab import GitlabHTTPServer, GitlabHTTPHandler  # noqa: E402
+from repowatch.metrics import METRICS  # noqa: E402
+
+CONFIG = '''
+[repowatch]
+reconcile_interval = 0
+ssh_multiplex = False
+
+[gerrit]
+username = bench
+hostname = localhost
+port = 29418
+threads = {threads}
+url = file://{repos}/{{project}}
+{extra}
+
+[gitlab]
+username = bench
+hostname = localhost
+port = 22
+threads = {threads}
+url = file://{repos}/{{project}}
+{extra}
+'''
+
+
+class RecordingQueue(CoalescingQueue):
+    ''' Records how long every event took from being received until done '''
+
+    def __init__(self, *args, **kwargs):
+        CoalescingQueue.__init__(self, *args, **kwargs)
+        self.latencies = []
+        self.finished = None
+
+    def done(self, event):
+        CoalescingQueue.done(self, event)
+        if 'received' in event:
+            self.latencies.append(time() - event['received'])
+            self.finished = time()
+
+    def idle(self):
+        with self.mutex:
+            return not self.pending and not self.active
+
+
+def git(args, cwd, stdin=None):
+    p = subprocess.Popen(['git'] + args, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         env=dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+                                  GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com'))
+    out, _ = p.communicate(stdin)
+    if p.returncode != 0:
+        raise RuntimeError('git {0} failed'.format(' '.join(args)))
+    return out
+
+
+def create_repo(path, branches, history, files):
+    ''' Bare repository with history commits on master and branches pointing into it
+
+        returns the list of commit shas
+    '''
+    os.makedirs(path)
+    git(['init', '-q', '--bare'], path)
+    stream = []
+    for i in range(1, history + 1):
+        stream.append('commit refs/heads/master\nmark :{0}\n'
+                      'committer bench <bench@example.com> {1} +0000\n'
+                      'data 8\ncommit {2:01d}\n'.format(i, 1500000000 + i, i % 10))
+        if i > 1:
+            stream.append('from :{0}\n'.format(i - 1))
+        for f in range(0, files if i == 1 else 1):
+            name = 'file{0}'.format(f if i == 1 else random.randint(0, files - 1))
+            content = '{0} {1}\n'.format(name, i) * 32
+            stream.append('M 644 inline {0}\ndata {1}\n{2}\n'.format(name, len(content), content))
+    for b in range(0, branches):
+        stream.append('reset refs/heads/branch{0}\nfrom :{1}\n\n'.format(b, random.randint(1, history)))
+    git(['fast-import', '--quiet'], path, ''.join(stream))
+    return git(['rev-list', 'master'], path).split()
+
+
+def disk_usage(*paths):
+    ''' Bytes used, files hardlinked or shared are counted once, trash is not counted '''
+    seen = set()
+    total = 0
+    for path in paths:
+        for root, dirs, names in os.walk(path):
+            # being removed in the background
+            dirs[:] = [d for d in dirs if not d.startswith(TRASH_PREFIX)]
+            for name in names:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_blocks * 512
+    return total
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark repowatch against local repositories')
+    parser.add_argument('--projects', type=int, default=4, help='projects, half Gerrit and half GitLab')
+    parser.add_argument('--branches', type=int, default=20, help='branches per project')
+    parser.add_argument('--history', type=int, default=200, help='commits per project')
+    parser.add_argument('--files', type=int, default=50, help='files per project')
+    parser.add_argument('--events', type=int, default=200, help='events to send')
+    parser.add_argument('--rate', type=float, default=50, help='events per second')
+    parser.add_argument('--threads', type=int, default=4, help='worker threads per section')
+    parser.add_argument('--mirror', action='store_true', help='use a shared mirror per project')
+    parser.add_argument('--publish', action='store_true', help='publish checkouts atomically through symlinks')
+    parser.add_argument('--backend', default='subprocess', help='git_backend to use')
+    parser.add_argument('--workdir', help='directory to work in, default a new temporary one')
+    parser.add_argument('--keep', action='store_true', help='do not remove the work directory')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the workers')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='repowatch-bench-')
+    repos = os.path.join(workdir, 'repos')
+    checkouts = os.path.join(workdir, 'checkouts')
+    mirrors = os.path.join(workdir, 'mirrors')
+
+    try:
+        print('Creating {0} repositories in {1}'.format(args.projects, repos))
+        projects = []
+        commits = dict()
+        for i in range(0, args.projects):
+            name = 'bench/project{0}'.format(i)
+            projects.append({'project': name,
+                             'type': 'gerrit' if i % 2 == 0 else 'gitlab',
+                             'path': os.path.join(checkouts, name)})
+            commits[name] = create_repo(os.path.join(repos, name + '.git'),
+                                        args.branches, args.history, args.files)
+
+        extra = 'git_backend = {0}\n'.format(args.backend)
+        if args.mirror:
+            extra += 'mirror_dir = {0}\n'.format(mirrors)
+        if args.publish:
+            extra += 'atomic_publish = True\n'
+        with open(os.path.join(workdir, 'repowatch.conf'), 'w') as fh:
+            fh.write(CONFIG.format(threads=args.threads, repos=repos, extra=extra))
+        with open(os.path.join(workdir, 'projects.yaml'), 'w') as fh:
+            json.dump(projects, fh)
+
+        rw = repowatch.RepoWatch(os.path.join(workdir, 'repowatch.conf'),
+                                 os.path.join(workdir, 'projects.yaml'),
+                                 False, False, False)
+        logging.getLogger('repowatch').setLevel(logging.WARNING)
+        rw.queue = RecordingQueue()
+        rw.setup()
+        for thread in rw.threads.values():
+            if isinstance(thread, (Worker, Trash)):
+                thread.start()
+
+        httpd = GitlabHTTPServer(('127.0.0.1', 0), GitlabHTTPHandler, rw.queue)
+        http_thread = threading.Thread(target=httpd.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+        gerrit = rw.threads['gerrit']
+
+        connection = httplib.HTTPConnection('127.0.0.1', httpd.server_address[1])
+
+        print('Sending {0} events at {1}/s'.format(args.events, args.rate))
+        start = time()
+        for i in range(0, args.events):
+            project = random.choice(projects)
+            branch = 'branch{0}'.format(random.randint(0, args.branches - 1))
+            sha = random.choice(commits[project['project']])
+            git(['update-ref', 'refs/heads/' + branch, sha], os.path.join(repos, project['project'] + '.git'))
+
+            if project['type'] == 'gerrit':
+                gerrit.handle_event({'type': 'ref-updated',
+                                     'eventCreatedOn': int(time()),
+                                     'refUpdate': {'project': project['project'],
+                                                   'refName': branch,
+                                                   'newRev': sha}})
+            else:
+                connection.request('POST', '/', json.dumps({'after': sha,
+                                                            'ref': 'refs/heads/' + branch,
+                                                            'repository': {
+                                                                'url': 'git@localhost:{0}.git'.format(
+                                                                    project['project'])}}))
+                connection.getresponse().read()
+
+            delay = start + (i + 1) / args.rate - time()
+            if delay > 0:
+                sleep(delay)
+        sent = time()
+
+        while not rw.queue.idle() and time() - start < args.timeout:
+            sleep(0.05)
+        if not rw.queue.idle():
+            print('Timed out waiting for the workers')
+
+        latencies = rw.queue.latencies
+        duration = (rw.queue.finished or sent) - start
+        commands = sum(v for (name, _), v in METRICS.values.items() if name == 'repowatch_subprocess_total')
+        failures = sum(v for (name, _), v in METRICS.values.items()
+                       if name == 'repowatch_subprocess_failures_total')
+
+        print('')
+        print('events sent        {0} in {1:.2f}s'.format(args.events, sent - start))
+        print('events done        {0} ({1} merged in the queue)'.format(len(latencies), rw.queue.merged))
+        print('events/sec         {0:.1f}'.format(len(latencies) / duration if duration else 0))
+        print('latency p50        {0:.3f}s'.format(percentile(latencies, 50)))
+        print('latency p99        {0:.3f}s'.format(percentile(latencies, 99)))
+        print('commands run       {0} ({1} failed)'.format(commands, failures))
+        print('disk used          {0:.1f} MB'.format(disk_usage(checkouts, mirrors) / 1024.0 / 1024.0))
+
+        connection.close()
+        httpd.shutdown()
+        for thread in rw.threads.values():
+            thread.running = False
+        for thread in rw.threads.values():
+            if thread.is_alive():
+                thread.join()
+    finally:
+        if args.keep:
+            print('Kept {0}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
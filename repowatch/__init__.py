@@ -4,14 +4,18 @@
 
 import os
 import sys
+import signal
+import socket
+import itertools
 import traceback
 import logging
 import logging.handlers
+import threading
 import Queue
-from threading import Lock
 import ConfigParser
+from collections import OrderedDict
 from multiprocessing import cpu_count
-from time import sleep
+from time import time, sleep
 from resource import getrlimit, RLIMIT_NOFILE
 from contextlib import contextmanager
 
@@ -27,11 +31,46 @@ import yaml
 from .gitlab import WatchGitlab
 from .gerrit import WatchGerrit
 from .worker import Worker
-from .util import create_ssh_wrapper, cleanup_ssh_wrapper, run_cmd, get_remote_branches
+from .executor import CommandExecutor, CommandRunner
+from .gitbackend import get_backend
+from .eventqueue import CoalescingQueue, BULK, DEFAULT_BULK_EVERY
+from .state import BranchState
+from .journal import Journal
+from .matcher import ProjectIndex, is_pattern
+from .scaler import WorkerScaler
+from .cluster import Cluster, ClusterServer, FileCoordinator, Router, \
+    DEFAULT_PORT as DEFAULT_CLUSTER_PORT, DEFAULT_TTL as DEFAULT_CLUSTER_TTL
+from .reconcile import Reconciler, Trash
+from .metrics import METRICS, MetricsServer
+from . import trace
+from .util import create_ssh_wrapper, cleanup_ssh_wrapper, run_cmd, to_bool, KeyedLock, \
+    HostSlots, remote_url, create_ssh_control_dir, cleanup_ssh_control_dir, HOST_BUDGET
 
 # be careful not to exceed the ssh MaxStartups threshold (default 10)
 DEFAULT_THREADS = cpu_count() * 2 if (cpu_count() * 2) < 10 else 10
 
+# config sections for git servers, also the project types
+SECTIONS = ('gerrit', 'gitlab')
+
+# seconds between checks for changes to the config files with watch_config
+RELOAD_CHECK = 5
+
+# what a project listed more than once may set per place it is checked out
+DESTINATION_KEYS = ('path', 'cmds', 'sparse')
+
+# at most this many ls-remote per host during the initial checkout
+DEFAULT_DISCOVERY_PER_HOST = 4
+
+KNOWN_HOST_FILES = [
+    os.path.join(os.path.expanduser('~'), '.ssh/known_hosts'),
+    '/etc/ssh/ssh_known_hosts',
+    '/etc/ssh/ssh_known_hosts2']
+
+
+def places(project):
+    ''' Type and the paths of a project, when they change it is checked out anew '''
+    return (project['type'], project['path']) + tuple(d['path'] for d in project.get('destinations', ()))
+
 
 @contextmanager
 def FakeContext():
@@ -52,6 +91,9 @@ class NoLock(object):
     '''
     This sets up a object that looks like a lock but doesn't act like one
     '''
+    def __call__(self, key):
+        return self
+
     def __enter__(self):
         pass
 
@@ -64,17 +106,43 @@ class RepoWatch(object):
     Manages the threads that watch for events and acts on events that come in
     '''
 
-    def __init__(self, config_file, project_file, pid_file, syslog, debug, only_once=False):
-        self.queue = Queue.Queue()
+    def __init__(self, config_file, project_file, pid_file, syslog, debug, only_once=False, profile=None):
+        # bounded by queue_max from the config in setup()
+        self.queue = CoalescingQueue()
 
         # read project config to determine what threads we need to start
-        self.projects = {}
+        self.projects = ProjectIndex()
         self.options = dict()
+        self.settings = dict()
         self.threads = dict()
         self.wrapper = None
+        self.ssh_control_dir = None
+        self.reconciler = None
+        self.state = None
+        self.journal = None
+        self.cluster = None
+        self.router = None
+        self.executor = None
+        self.backends = dict()
+        self.section_options = dict()
+        self.section_threads = dict()
+        self.locks = dict()
+        self.command_limits = dict()
+        self.trash = None
+        self.reload_requested = False
+        self.applying_reload = False
+        self.config_mtimes = None
         self.only_once = only_once
+        self.profile = profile
+        self.sampler = None
 
         self.worker_threads = 0
+        self.workers_lock = threading.Lock()
+        self.autoscale = False
+
+        self.known_hosts = dict()
+        self.known_hosts_lock = threading.Lock()
+        self.discovery_slots = None
 
         self.project_file = project_file
         self.config_file = config_file
@@ -99,26 +167,42 @@ class RepoWatch(object):
                 "RepoWatch[%(process)s]: %(threadName)s:%(name)s: %(message)s"))
             self.logger.addHandler(self.syslog)
 
-    def setup(self):
-        # Config
-        self.logger.info('Reading config')
-        needed = dict(gerrit=False, gitlab=False)
+    def read_projects(self):
+        ''' Returns the projects from the project file as a ProjectIndex, raises ValueError if they are bad '''
         try:
             project_yaml = open(self.project_file)
         except IOError:
             self.logger.error(
                 'Could not find project yaml file at: %s', self.project_file)
             raise Exception
+        entries = OrderedDict()
         for p in yaml.safe_load(project_yaml):
-            self.projects[p['project']] = p
-            if p['type'] in needed:
-                needed[p['type']] = True
-            else:
+            name = p.get('regex') or p['project']
+            if p['type'] not in SECTIONS:
                 self.logger.error('Bad type for project %s, must be one of %s',
-                                  p['project'],
-                                  needed.keys())
-                sys.exit(1)
+                                  name,
+                                  SECTIONS)
+                raise ValueError(name)
+            if name not in entries:
+                entries[name] = p
+                continue
+            # listed again, one more place to check its branches out
+            first = entries[name]
+            if p['type'] != first['type']:
+                self.logger.error('Project %s is listed with different types', name)
+                raise ValueError(name)
+            first.setdefault('destinations', []).append(
+                dict((k, v) for k, v in p.items() if k in DESTINATION_KEYS))
+
+        projects = ProjectIndex()
+        for name, p in entries.items():
+            if p.get('regex') or is_pattern(name):
+                projects.add_pattern(p)
+            else:
+                projects[name] = p
+        return projects
 
+    def read_config(self):
         config = ConfigParser.ConfigParser()
         try:
             config_ini = open(self.config_file)
@@ -127,89 +211,535 @@ class RepoWatch(object):
                 'Could not find config file at: %s', self.config_file)
             raise Exception
         config.readfp(config_ini)
+        return config
 
-        self.wrapper = create_ssh_wrapper()
-
-        for repo, need in needed.items():
-            if need:
-                _options = dict()
+    def setup(self):
+        # Config
+        self.logger.info('Reading config')
+        try:
+            projects = self.read_projects()
+        except ValueError:
+            sys.exit(1)
+        config = self.read_config()
+        self.config_mtimes = self.file_mtimes()
+
+        # settings for the daemon itself rather than a gerrit/gitlab server
+        self.settings = dict(config.items('repowatch')) if config.has_section('repowatch') else dict()
+        self.queue.maxsize = int(self.settings.get('queue_max', 0))
+        self.queue.bulk_every = int(self.settings.get('bulk_every', DEFAULT_BULK_EVERY))
+        if self.settings.get('trace_file'):
+            trace.enable(self.settings['trace_file'])
+        if self.settings.get('state_dir'):
+            self.state = BranchState(self.settings['state_dir'])
+        if to_bool(self.settings.get('journal', False)):
+            if not self.settings.get('state_dir'):
+                self.logger.error('journal needs a state_dir')
+                sys.exit(1)
+            self.journal = Journal(os.path.join(self.settings['state_dir'], 'journal'),
+                                   float(self.settings.get('journal_sync', 0.1)))
+            self.queue.journal = self.journal
+        if self.settings.get('cluster_dir'):
+            self.setup_cluster()
+        owned = self.owned(projects)
+        self.projects.update(owned)
+        self.projects.use_patterns(owned)
+        self.discovery_slots = HostSlots(int(self.settings.get('discovery_per_host',
+                                                               DEFAULT_DISCOVERY_PER_HOST)))
+
+        # ssh connections are limited per host for everything we run
+        HOST_BUDGET.limit = int(self.settings.get('max_ssh_per_host', HOST_BUDGET.limit))
+
+        if to_bool(self.settings.get('ssh_multiplex', True)):
+            self.ssh_control_dir = create_ssh_control_dir()
+        self.wrapper = create_ssh_wrapper(self.ssh_control_dir,
+                                          int(self.settings.get('ssh_control_persist', 60)))
+
+        METRICS.set_function('repowatch_queue_depth', self.queue.qsize)
+        METRICS.set_function('repowatch_queue_merged_total', lambda: self.queue.merged)
+        METRICS.set_function('repowatch_queue_bulk_depth', lambda: self.queue.lane_size(BULK))
+        if self.settings.get('metrics_port'):
+            self.threads['metrics'] = MetricsServer(self.settings.get('metrics_address', ''),
+                                                    int(self.settings['metrics_port']))
+            self.threads['metrics'].daemon = True
+
+        self.reconciler = Reconciler(self.queue, self.projects,
+                                     int(self.settings.get('reconcile_delay', 60)),
+                                     int(self.settings.get('reconcile_interval', 3600)))
+        self.reconciler.daemon = True
+        self.threads['reconciler'] = self.reconciler
+        self.trash = Trash()
+        self.trash.daemon = True
+        self.threads['trash'] = self.trash
+
+        # workers are added and stopped with the work waiting, see worker_bounds
+        self.autoscale = to_bool(self.settings.get('autoscale', False))
+        if self.autoscale:
+            self.threads['scaler'] = WorkerScaler(self.queue, self.section_threads, self.worker_bounds,
+                                                  lambda repo, n: self.start_workers(repo, n, start=True),
+                                                  float(self.settings.get('autoscale_interval', 5)),
+                                                  float(self.settings.get('scale_up_age', 10)),
+                                                  float(self.settings.get('scale_down_idle', 60)),
+                                                  float(self.settings.get('max_load', 1.0)))
+            self.threads['scaler'].daemon = True
+
+        # user commands run in threads of their own, otherwise in the workers
+        command_threads = int(self.settings.get('command_threads', 0))
+        if command_threads:
+            self.executor = CommandExecutor(self.command_limit)
+            METRICS.set_function('repowatch_command_queue_depth', self.executor.queue.qsize)
+            self.logger.info('Starting {0} command threads'.format(command_threads))
+            for i in range(0, command_threads):
+                thread_name = 'command-{0}'.format(i)
+                self.threads[thread_name] = CommandRunner(self.executor, thread_name)
+                self.threads[thread_name].daemon = True
+
+        # in a cluster every node watches every section, events are routed
+        for repo in SECTIONS:
+            if repo in projects.types():
                 try:
-                    _options.update(config.items(repo))
+                    options = dict(config.items(repo))
                 except ConfigParser.NoSectionError:
                     logging.exception(
                         'Unable to read %s configuration? Does it exist?', repo)
                     sys.exit(1)
-
-                self.options[repo] = _options
-                modul = get_class('Watch{0}'.format(repo.capitalize()))
                 try:
-                    self.threads[repo] = modul(_options, self.queue)
-                except Exception as e:
-                    self.logger.info('Error instantiating watcher: %s', e)
-                self.threads[repo].daemon = True
-
-                if _options.get('sequential_project_commands', False):
-                    lock = Lock()
-                else:
-                    lock = NoLock()
-
-                num_threads = int(_options.get('threads', DEFAULT_THREADS))
-                self.worker_threads += num_threads
-                self.logger.info('Starting {0} worker threads'.format(num_threads))
-                for i in range(0, num_threads):
-                    thread_name = '{0}-worker-{1}'.format(repo, i)
-                    self.threads[thread_name] = Worker(
-                        _options, self.queue, self.wrapper, self.projects, lock)
-                    self.threads[thread_name].daemon = True
+                    self.start_section(repo, options)
+                except (ImportError, ValueError) as e:
+                    self.logger.error('Bad git_backend for %s: %s', repo, e)
+                    sys.exit(1)
 
         self.logger.info('Finished config')
 
-    def _initial_checkout(self):
-        ''' Look at all branches and check them out '''
-        self.logger.info('Doing initial checkout of branches')
+    def setup_cluster(self):
+        ''' Share the projects with the other nodes using cluster_dir '''
+        if not self.settings.get('cluster_token'):
+            self.logger.error('cluster_dir needs a cluster_token')
+            sys.exit(1)
+        token = self.settings['cluster_token']
+        port = int(self.settings.get('cluster_port', DEFAULT_CLUSTER_PORT))
+        node = self.settings.get('cluster_node', '{0}:{1}'.format(socket.getfqdn(), port))
+        address = self.settings.get('cluster_address', '{0}:{1}'.format(socket.getfqdn(), port))
+        coordinator = FileCoordinator(self.settings['cluster_dir'],
+                                      int(self.settings.get('cluster_ttl', DEFAULT_CLUSTER_TTL)))
+        # a change of members moves projects, which a reload applies
+        self.cluster = Cluster(coordinator, node, address, on_change=self.request_reload)
+        # the projects this node owns are picked from the members, so they have to be known first
+        self.cluster.settle()
+        self.cluster.daemon = True
+        self.threads['cluster'] = self.cluster
+        # only where the other nodes reach us
+        self.threads['cluster-server'] = ClusterServer(self.settings.get('cluster_listen_address',
+                                                                         address.rsplit(':', 1)[0]),
+                                                       port, self.queue, token, self.cluster.owns)
+        self.threads['cluster-server'].daemon = True
+        self.router = Router(self.cluster, self.queue, token)
+        self.logger.info('Node %s of a cluster of %s', node, len(self.cluster.members))
+
+    def owned(self, projects):
+        ''' The projects this node works on, all of them without a cluster '''
+        if self.cluster is None:
+            return projects
+        return projects.filter(self.cluster.owns)
+
+    def new_watcher(self, repo, options):
+        ''' Watcher thread of a section, in a cluster events go through the router '''
+        watcher = get_class('Watch{0}'.format(repo.capitalize()))(options, self.router or self.queue)
+        if self.cluster is not None and hasattr(watcher, 'active'):
+            watcher.active = self.cluster.is_leader
+            watcher.takeover_lag = self.cluster.coordinator.ttl
+        watcher.daemon = True
+        return watcher
+
+    def start_section(self, repo, options, start=False):
+        ''' Set up the watcher and workers of a config section, start them if start is set '''
+        backend = get_backend(options, self.wrapper)
+        self.section_options[repo] = dict(options)
+        self.options[repo] = options
+        self.backends[repo] = backend
+        try:
+            self.threads[repo] = self.new_watcher(repo, options)
+        except Exception as e:
+            self.logger.info('Error instantiating watcher: %s', e)
+        if start:
+            self.threads[repo].start()
+
+        self.set_lock(repo)
+        self.set_command_limits(repo)
+
+        self.section_threads[repo] = 0
+        self.start_workers(repo, self.worker_bounds()[repo][0 if self.autoscale else 1], start)
+
+    def worker_bounds(self):
+        ''' Returns the smallest and largest number of workers by section
+
+            with autoscale threads is the most a section grows to, no more
+            than may connect to a host at once, and min_threads the fewest
+        '''
+        bounds = dict()
+        for repo, options in self.options.items():
+            high = int(options.get('threads', DEFAULT_THREADS))
+            if self.autoscale:
+                high = min(high, HOST_BUDGET.limit)
+            bounds[repo] = (min(int(options.get('min_threads', 1)), high), high)
+        return bounds
+
+    def set_lock(self, repo):
+        ''' work on a branch directory is always serialized by the queue,
+            this additionally runs user commands one at a time per project
+        '''
+        if to_bool(self.options[repo].get('sequential_project_commands', False)):
+            self.locks[repo] = KeyedLock()
+        else:
+            self.locks[repo] = NoLock()
 
-        for project, data in self.projects.items():
-            self.logger.info('Checking that ssh host key is known')
-            hostname = self.options[data['type']]['hostname']
+    def set_command_limits(self, repo):
+        options = self.options[repo]
+        if to_bool(options.get('sequential_project_commands', False)):
+            self.command_limits[repo] = 1
+        else:
+            self.command_limits[repo] = int(options.get('command_concurrency', 0))
+
+    def command_limit(self, project):
+        ''' How many user commands of a project may run at once, 0 for no limit '''
+        data = self.projects.get(project)
+        return self.command_limits.get(data['type'], 0) if data else 0
+
+    def project_lock(self, project):
+        ''' Lock around the user commands of a project, as its section is set up now '''
+        return self.locks[self.projects[project]['type']](project)
+
+    def start_workers(self, repo, num_threads, start=False):
+        ''' Add worker threads for a section, fewer than zero stops that many, idle ones first '''
+        with self.workers_lock:
+            self._start_workers(repo, num_threads, start)
+
+    def _start_workers(self, repo, num_threads, start):
+        self.section_threads[repo] += num_threads
+        self.worker_threads += num_threads
+        METRICS.set('repowatch_workers', self.worker_threads)
+        if num_threads < 0:
+            self.logger.info('Stopping {0} worker threads'.format(-num_threads))
+            # workers take events of every section, so stop ones of this section
+            # rather than queueing shutdowns any worker could take
+            workers = sorted((thread for thread in self.threads.values()
+                              if isinstance(thread, Worker) and thread.section_name == repo and thread.running),
+                             key=lambda thread: thread.busy)
+            for worker in workers[:-num_threads]:
+                # a busy worker stops when its event is done
+                worker.running = False
+            return
+
+        self.logger.info('Starting {0} worker threads'.format(num_threads))
+        names = ('{0}-worker-{1}'.format(repo, i) for i in itertools.count())
+        for i in range(0, num_threads):
+            thread_name = next(name for name in names
+                               if name not in self.threads or not self.threads[name].is_alive())
+            self.threads[thread_name] = Worker(
+                self.options, self.queue, self.wrapper, self.projects, self.project_lock, self.state,
+                self.trash, self.threads, self.executor, self.backends, repo)
+            self.threads[thread_name].daemon = True
+            if start:
+                self.threads[thread_name].start()
+
+    def file_mtimes(self):
+        mtimes = []
+        for path in (self.config_file, self.project_file):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested = True
+
+    def reload(self):
+        ''' Apply changes to the project file and config file while running
+
+            Only what changed is touched: new sections get a watcher and
+            workers, sections with changed options get a new watcher, added
+            projects get an initial checkout and removed projects are drained,
+            their waiting events are dropped and running ones finish first.
+            Projects that did not change keep running as they are.
+
+            Waiting for the removed projects and checking out the added ones
+            is done in the reload-discovery thread, a reload requested before
+            the removed projects are gone is done after that.
+        '''
+        if self.applying_reload:
+            return
+        self.reload_requested = False
+        self.config_mtimes = self.file_mtimes()
+        self.logger.info('Reloading config')
+        try:
+            projects = self.read_projects()
+            config = self.read_config()
+        except Exception:
+            self.logger.exception('Not reloading, could not read the config')
+            return
+
+        settings = dict(config.items('repowatch')) if config.has_section('repowatch') else dict()
+        changed = sorted(k for k in set(settings) | set(self.settings) if settings.get(k) != self.settings.get(k))
+        if changed:
+            self.logger.warn('Changes to %s in [repowatch] need a restart', ', '.join(changed))
+
+        for repo in SECTIONS:
+            if repo not in projects.types():
+                continue
+            try:
+                options = dict(config.items(repo))
+            except ConfigParser.NoSectionError:
+                self.logger.error('Not reloading, %s configuration is missing', repo)
+                return
+            try:
+                if repo not in self.options:
+                    self.logger.info('Starting new section %s', repo)
+                    self.start_section(repo, options, start=True)
+                elif options != self.section_options[repo]:
+                    self.restart_section(repo, options)
+            except (ImportError, ValueError) as e:
+                self.logger.error('Not reloading %s, bad git_backend: %s', repo, e)
+                return
+
+        self.applying_reload = True
+        self.threads['reload-discovery'] = threading.Thread(target=self._apply_projects,
+                                                            args=(projects,),
+                                                            name='reload-discovery')
+        self.threads['reload-discovery'].daemon = True
+        self.threads['reload-discovery'].start()
+
+    def _apply_projects(self, projects):
+        ''' Drain the removed projects and check out the added ones of a reload '''
+        try:
+            # projects that moved to another node of the cluster count as removed
+            owned = self.owned(projects)
+            old = set(self.projects)
+            removed = [p for p in old if p not in owned or places(owned[p]) != places(self.projects[p])]
+            self.drain_projects(removed)
+            for repo in [r for r in self.options if r not in projects.types()]:
+                self.stop_section(repo)
+            projects = owned
+
+            patterns_changed = projects.patterns != self.projects.patterns
+            self.projects.use_patterns(projects)
+            # projects whose path changed were removed above and come back
+            set_removed = set(removed)
+            added = [p for p in projects if p not in old or p in set_removed]
+            for name, data in projects.items():
+                self.projects[name] = data
+            # projects found by patterns are dropped when removed too, take them back if they fit again
+            for name in set(added) | set(p for p in list(self.queue.draining) if p in self.projects):
+                self.queue.resume(name)
+                if self.executor is not None:
+                    self.executor.queue.resume(name)
+            for repo in self.options.keys():
+                self.set_command_limits(repo)
+
+            self.logger.info('Reloaded config, %s projects added, %s removed, %s unchanged',
+                             len(added),
+                             len([p for p in removed if p not in projects]),
+                             len(set(old) & set(projects)) - len([p for p in removed if p in projects]))
+        except Exception:
+            self.logger.exception('Error applying the reloaded projects')
+            return
+        finally:
+            self.applying_reload = False
+        if added or patterns_changed:
+            self._checkout_added(added, patterns_changed)
+
+    def restart_section(self, repo, options):
+        ''' Use changed options of a running section, the watcher is replaced '''
+        self.logger.info('Options of %s changed, restarting its watcher', repo)
+        old = self.threads[repo]
+        old.stop()
+        old.join(10)
+        self.backends[repo] = get_backend(options, self.wrapper)
+        sequential = to_bool(options.get('sequential_project_commands', False))
+        changed_lock = sequential != to_bool(self.section_options[repo].get('sequential_project_commands', False))
+        self.section_options[repo] = dict(options)
+        self.options[repo] = options
+        if changed_lock:
+            # workers look the lock up for every project, so this takes effect now
+            self.set_lock(repo)
+        self.threads[repo] = self.new_watcher(repo, options)
+        # the new stream catches up from where the old one was
+        self.threads[repo].last_event = getattr(old, 'last_event', None)
+        self.threads[repo].start()
+
+        # with autoscale the scaler fits the workers to the new bounds
+        num_threads = int(options.get('threads', DEFAULT_THREADS))
+        if not self.autoscale and num_threads != self.section_threads[repo]:
+            self.start_workers(repo, num_threads - self.section_threads[repo], start=True)
+
+    def stop_section(self, repo):
+        ''' Stop the watcher and workers of a section that has no projects left '''
+        self.logger.info('No projects left in %s, stopping it', repo)
+        self.threads[repo].stop()
+        self.start_workers(repo, -self.section_threads[repo])
+        del self.options[repo]
+        del self.section_options[repo]
+        del self.backends[repo]
+
+    def drain_projects(self, projects, timeout=600):
+        ''' Stop work on projects and forget them once running work is done '''
+        waiting = list(projects)
+        end = time() + timeout
+        while waiting:
+            waiting = [p for p in waiting
+                       if not self.queue.drain(p) or
+                       (self.executor is not None and not self.executor.queue.drain(p))]
+            if not waiting or time() > end:
+                break
+            sleep(0.5)
+        if waiting:
+            self.logger.warn('Still working on removed projects %s', ', '.join(waiting))
+        for project in projects:
+            self.logger.info('Removed project %s', project)
+            del self.projects[project]
+
+    def _host_key_known(self, hostname):
+        ''' Check the known_hosts files for a host, the answer is cached per host '''
+        with self.known_hosts_lock:
+            if hostname not in self.known_hosts:
+                self.logger.info('Checking that ssh host key is known for %s', hostname)
+                known = False
+                for known_host_file in KNOWN_HOST_FILES:
+                    known = run_cmd('ssh-keygen -F {0} -f {1}'.format(hostname, known_host_file),
+                                    wrapper=self.wrapper)
+                    if known:
+                        break
+                self.known_hosts[hostname] = known is not False
+            return self.known_hosts[hostname]
+
+    def _queue_update(self, event):
+        ''' Queue an update unless the state says the directory is already there at that sha
+
+            these are bulk work, live events from the watchers go first
+        '''
+        directory = event.get('output_dir') or event['branch_name']
+        if (self.state and self.state.is_current(event['project_name'], directory, event['sha']) and
+                os.path.isdir(os.path.join(self.projects[event['project_name']]['path'], directory))):
+            return
+        self.logger.debug(
+            'Adding project branch to queue: {0}:{1}'.format(event['project_name'], directory))
+        event['lane'] = BULK
+        self.queue.put(event)
+
+    def _discover_extra(self, section, projects):
+        ''' Queue the extra refs of the projects of a section, like open Gerrit changes '''
+        try:
+            for event in self.threads[section].get_extra(projects):
+                if event['project_name'] in self.projects:
+                    self._queue_update(event)
+        except Exception:
+            self.logger.exception('Error discovering extra refs of %s projects', section)
+
+    def _discover_project(self, project):
+        ''' ls-remote one project and queue the branches that need updating '''
+        data = self.projects[project]
+        options = self.options[data['type']]
+
+        with self.discovery_slots(options['hostname']), HOST_BUDGET(options['hostname']):
+            remote = self.backends[data['type']].ls_remote(remote_url(options, project, '.git'))
+        if remote:
+            for branch, sha in remote:
+                self._queue_update({'type': 'update',
+                                    'project_name': project,
+                                    'branch_name': branch,
+                                    'sha': sha})
 
-            known_host_files = [
-                os.path.join(os.path.expanduser('~'), '.ssh/known_hosts'),
-                '/etc/ssh/ssh_known_hosts',
-                '/etc/ssh/ssh_known_hosts2']
+            # also delete those pesky old branches, after the updates had time to go through
+            if self.only_once:
+                self.queue.put({'type': 'reconcile',
+                                'lane': BULK,
+                                'project_name': project})
+            else:
+                self.reconciler.request(project)
+        else:
+            self.logger.warn('Did not find remote heads for %s', project)
 
-            for known_host_file in known_host_files:
-                known = run_cmd('ssh-keygen -F {0} -f {1}'.format(hostname, known_host_file),
-                                wrapper=self.wrapper)
-                if known:
-                    break
+    def _discovery_thread(self, projects):
+        while True:
+            try:
+                project = projects.get(False)
+            except Queue.Empty:
+                return
+            try:
+                self._discover_project(project)
+            except Exception:
+                self.logger.exception('Error discovering branches of %s', project)
+
+    def _initial_checkout(self, names=None):
+        ''' Look at all branches and check them out
+
+            Projects are looked at by several threads at once with a limit per
+            host, branches are queued as they are found so the workers should be
+            running already. names limits this to some projects, like the ones
+            added by a reload.
+        '''
+        if names is None:
+            self.find_matching()
+            names = list(self.projects)
+        self.logger.info('Doing initial checkout of branches')
 
-            if known is False:
+        sections = set(self.projects[name]['type'] for name in names)
+        for section in sections:
+            if not self._host_key_known(self.options[section]['hostname']):
                 self.logger.error('SSH host key not known! Exiting!')
                 raise Exception  # TODO: need more specific Exception here!
 
-            remote = run_cmd('git ls-remote --heads '
-                             'ssh://{0}@{1}:{2}/{3}.git'.format(self.options[data['type']]['username'],
-                                                                self.options[data['type']]['hostname'],
-                                                                self.options[data['type']]['port'],
-                                                                project),
-                             wrapper=self.wrapper,
-                             ssh_key=self.options[data['type']].get('key_filename', None))
-            if remote:
-                for branch in get_remote_branches(remote):
-                    self.logger.debug(
-                        'Adding project branch to queue: {0}:{1}'.format(project, branch))
-                    self.queue.put({'type': 'update',
-                                    'project_name': project,
-                                    'branch_name': branch})
-
-                # also delete those pesky old branches
-                self.queue.put({'type': 'delete',
-                                'project_name': project})
-                # check out extra branches like issues or changesets TODO
-                # for ref, outdir in self.threads[data['type']].get_extra(project):
-                #     self.update_branch(project, ref, outdir)
-            else:
-                self.logger.warn('Did not find remote heads for %s', project)
+        projects = Queue.Queue()
+        for project in names:
+            projects.put(project)
+
+        num_threads = int(self.settings.get('discovery_threads', DEFAULT_THREADS))
+        threads = [threading.Thread(target=self._discovery_thread,
+                                    args=(projects,),
+                                    name='discovery-{0}'.format(i))
+                   for i in range(0, min(num_threads, len(names)))]
+        # check out extra branches like issues or changesets
+        for section in sections:
+            threads.append(threading.Thread(target=self._discover_extra,
+                                            args=(section, [p for p in names
+                                                            if self.projects[p]['type'] == section]),
+                                            name='discovery-{0}-extra'.format(section)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # a join without a timeout would keep signals from the main thread
+            while thread.is_alive():
+                thread.join(1)
+        self.logger.info('Finished discovering branches of %s projects', len(names))
+
+    def find_matching(self):
+        ''' Add the projects on the servers that fit a pattern, returns their names
+
+            only servers that can list their projects are asked, the others
+            get their projects added by the first event for each
+        '''
+        found = []
+        known = set(self.projects.keys())
+        for section in set(p['type'] for p in self.projects.patterns if p['type'] in self.options):
+            try:
+                names = self.threads[section].list_projects()
+            except Exception:
+                self.logger.exception('Could not list the projects of %s', section)
+                continue
+            for name in names:
+                if name not in known and self.projects.lookup(name, section) is not None:
+                    found.append(name)
+        if found:
+            self.logger.info('Found %s projects matching patterns', len(found))
+        return found
+
+    def _checkout_added(self, names, find_matching=False):
+        try:
+            if find_matching:
+                names = names + self.find_matching()
+            self._initial_checkout(names)
+        except Exception:
+            self.logger.exception('Error checking out added projects')
 
     @staticmethod
     def files_preserve_by_path(*paths):
@@ -253,16 +783,39 @@ class RepoWatch(object):
                 self.logger.info('Running in foreground')
 
             with context:
-                self._initial_checkout()
+                # before anything that takes long, a SIGHUP would otherwise end us
+                signal.signal(signal.SIGHUP, self.request_reload)
+
+                if self.profile:
+                    self.sampler = trace.Sampler(self.profile)
+                    self.sampler.daemon = True
+                    self.sampler.start()
+
+                if self.journal:
+                    # work that was waiting when we stopped goes first, all of
+                    # it, with the running events of a crash it can be more
+                    # than queue_max and no worker is taking any yet
+                    maxsize, self.queue.maxsize = self.queue.maxsize, 0
+                    for event in self.journal.load():
+                        self.queue.put(event)
+                    self.queue.maxsize = maxsize
+                    self.journal.daemon = True
+                    self.journal.start()
 
                 for _, thread in self.threads.items():
                     thread.start()
 
+                self._initial_checkout()
+
+                watch_config = to_bool(self.settings.get('watch_config', False))
                 while True:
                     try:
                         if self.only_once:
                             raise KeyboardInterrupt
-                        sleep(60)
+                        # a SIGHUP ends the sleep early
+                        sleep(RELOAD_CHECK if watch_config or self.cluster else 60)
+                        if self.reload_requested or (watch_config and self.file_mtimes() != self.config_mtimes):
+                            self.reload()
                     except KeyboardInterrupt:
                         for i in range(0, self.worker_threads):
                             self.queue.put({'type': 'shutdown'})
@@ -274,14 +827,24 @@ class RepoWatch(object):
         except Exception as e:
             self.logger.error(traceback.format_exception(*sys.exc_info()))
         finally:
-            self.logger.info('Shutting down')
+            self.logger.info('Shutting down, merged %s redundant events', self.queue.merged)
             try:
                 cleanup_ssh_wrapper(self.wrapper)
             except Exception:
                 self.logger.info('No SSH wrapper to clean?')
+            if self.ssh_control_dir:
+                cleanup_ssh_control_dir(self.ssh_control_dir)
             for _, thread in self.threads.items():
                 if thread.is_alive():
                     thread.running = False
                     self.logger.debug('waiting for {0}'.format(thread))
                     thread.join(5)
+            if self.cluster:
+                self.cluster.leave()
+            if self.journal:
+                self.journal.close()
+            if self.state:
+                self.state.close()
+            if self.sampler:
+                self.sampler.stop()
             sys.exit(0)
@@ -17,9 +17,12 @@ def cli():
                         help='Debug mode')
     parser.add_argument('--once', dest='only_once', action='store_true', default=False,
                         help='Only run once, no daemon')
+    parser.add_argument('--profile', dest='profile', action='store', default=None,
+                        help='Sample thread stacks and write them to this file on exit')
 
     args = parser.parse_args()
-    watcher = RepoWatch(args.config_file, args.project_file, args.pid_file, args.syslog, args.debug, args.only_once)
+    watcher = RepoWatch(args.config_file, args.project_file, args.pid_file, args.syslog, args.debug, args.only_once,
+                        args.profile)
     watcher.run()
 
 
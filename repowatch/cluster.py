@@ -0,0 +1,345 @@
+import os
+import hmac
+import json
+import socket
+import bisect
+import hashlib
+import logging
+import httplib
+import threading
+from time import time, sleep
+from Queue import Full
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from .metrics import METRICS
+
+LOG = logging.getLogger('repowatch.cluster')
+
+DEFAULT_PORT = 8001
+# seconds without a heartbeat after which a node is gone
+DEFAULT_TTL = 30
+# points on the ring per node, more spread the projects more evenly
+DEFAULT_REPLICAS = 64
+# seconds to wait for the owning node to take a forwarded event
+FORWARD_TIMEOUT = 10
+# header with the cluster_token shared by the nodes
+TOKEN_HEADER = 'X-Repowatch-Token'
+# the events a node forwards, other events only come from the node itself
+FORWARDED_TYPES = ('update', 'delete')
+
+
+def valid_event(event):
+    ''' True if a forwarded event is one a watcher sends, with directories inside the project '''
+    if not isinstance(event, dict) or event.get('type') not in FORWARDED_TYPES:
+        return False
+    if not isinstance(event.get('project_name'), basestring):
+        return False
+    for key in ('branch_name', 'output_dir'):
+        value = event.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, basestring) or '..' in value or value.startswith('/'):
+            return False
+    return True
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''
+    Consistent hashing of projects onto nodes
+
+    Every node has replicas points on a ring, a project belongs to the node
+    of the first point after its own hash. When a node joins or leaves only
+    the projects next to its points move, about 1/n of them.
+    '''
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self.nodes = sorted(nodes)
+        self.points = sorted((ring_hash('{0}#{1}'.format(node, i)), node)
+                             for node in self.nodes for i in range(0, replicas))
+        self.hashes = [h for h, _ in self.points]
+
+    def owner(self, key):
+        ''' The node key belongs to, None if there are no nodes '''
+        if not self.points:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class LocalCoordinator(object):
+    '''
+    Membership kept in memory, for a single node or several nodes in one
+    process like in tests
+    '''
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.nodes = dict()
+
+    def heartbeat(self, node, address):
+        with self.lock:
+            self.nodes[node] = (address, time())
+
+    def leave(self, node):
+        with self.lock:
+            self.nodes.pop(node, None)
+
+    def members(self):
+        ''' Returns {node: address} of the live nodes '''
+        now = time()
+        with self.lock:
+            return dict((node, address) for node, (address, seen) in self.nodes.items()
+                        if now - seen < self.ttl)
+
+
+class FileCoordinator(LocalCoordinator):
+    '''
+    Membership through heartbeat files in a directory all nodes share, e.g.
+    over NFS. Every node writes <node>.json in there, the ones not written
+    for ttl seconds are gone.
+    '''
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        LocalCoordinator.__init__(self, ttl)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, node):
+        return os.path.join(self.directory, node.replace('/', '_') + '.json')
+
+    def heartbeat(self, node, address):
+        path = self.path(node)
+        # renamed into place so readers never see half a file
+        with open(path + '.new', 'w') as fh:
+            json.dump({'node': node, 'address': address}, fh)
+        os.rename(path + '.new', path)
+
+    def leave(self, node):
+        try:
+            os.unlink(self.path(node))
+        except OSError:
+            pass
+
+    def members(self):
+        now = time()
+        members = dict()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime >= self.ttl:
+                    continue
+                with open(path) as fh:
+                    data = json.load(fh)
+            except (OSError, IOError, ValueError):
+                continue
+            members[data['node']] = data['address']
+        return members
+
+
+class Cluster(threading.Thread):
+    """ Keeps this node in the cluster and knows which node owns a project
+
+        Heartbeats go to the coordinator every ttl/3 seconds, when the
+        members change the ring is rebuilt and on_change() is called. The
+        node with the lowest name is the leader, it alone consumes event
+        streams that every node could read, like the Gerrit stream.
+    """
+
+    def __init__(self, coordinator, node, address, on_change=None):
+        self.coordinator = coordinator
+        self.node = node
+        self.address = address
+        self.on_change = on_change
+        self.logger = LOG
+
+        self.members = dict()
+        self.ring = HashRing()
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='cluster')
+
+    def join_cluster(self):
+        ''' Announce this node and read the members, returns True if they changed '''
+        self.coordinator.heartbeat(self.node, self.address)
+        members = self.coordinator.members()
+        members[self.node] = self.address
+        if members == self.members:
+            return False
+        self.logger.info('Cluster members: %s', ', '.join(sorted(members)))
+        self.members = members
+        self.ring = HashRing(members)
+        return True
+
+    def settle(self):
+        '''
+        Join and wait for the members to settle, at most ttl seconds
+
+        Nodes starting at the same time may not have written their first
+        heartbeat yet, so the members are read again every heartbeat round
+        until a round brings no change.
+        '''
+        deadline = time() + self.coordinator.ttl
+        self.join_cluster()
+        while time() < deadline:
+            sleep(min(self.coordinator.ttl / 3.0, max(deadline - time(), 0)))
+            if not self.join_cluster():
+                break
+
+    def leave(self):
+        ''' Leave the cluster now, the other nodes take over our projects '''
+        self.coordinator.leave(self.node)
+
+    def owner(self, project):
+        return self.ring.owner(project)
+
+    def owns(self, project):
+        return self.ring.owner(project) == self.node
+
+    def is_leader(self):
+        return bool(self.members) and min(self.members) == self.node
+
+    def run(self):
+        while self.running:
+            sleep(max(self.coordinator.ttl / 3.0, 1))
+            try:
+                if self.join_cluster() and self.on_change:
+                    self.on_change()
+            except Exception:
+                self.logger.exception('Error updating the cluster members')
+        self.leave()
+
+
+class Router(object):
+    '''
+    Puts events of projects this node owns in the local queue and sends the
+    others to the node that owns them, used by the watchers instead of the
+    queue. Raises Queue.Full when the owner cannot be reached, like a full
+    queue, so GitLab retries the web hook and the Gerrit stream catches up.
+    token is the secret the nodes share, the owner only takes events with it.
+    '''
+
+    def __init__(self, cluster, queue, token):
+        self.cluster = cluster
+        self.queue = queue
+        self.token = token
+
+    def put(self, event, block=True, timeout=None):
+        owner = self.cluster.owner(event.get('project_name', ''))
+        if owner is None or owner == self.cluster.node:
+            return self.queue.put(event, block, timeout)
+        address = self.cluster.members.get(owner)
+        try:
+            host, port = address.rsplit(':', 1)
+            connection = httplib.HTTPConnection(host, int(port), timeout=FORWARD_TIMEOUT)
+            try:
+                connection.request('POST', '/event', json.dumps(event), {'Content-Type': 'application/json',
+                                                                         TOKEN_HEADER: self.token})
+                status = connection.getresponse().status
+            finally:
+                connection.close()
+        except (socket.error, httplib.HTTPException, AttributeError, ValueError) as e:
+            status = e
+        if status != 200:
+            METRICS.inc('repowatch_cluster_forward_failures_total', node=owner)
+            LOG.warn('Could not forward event of %s to %s at %s: %s',
+                     event.get('project_name'), owner, address, status)
+            raise Full
+        METRICS.inc('repowatch_cluster_forwarded_total', node=owner)
+        return False
+
+
+class ClusterHTTPHandler(BaseHTTPRequestHandler):
+    def send_text(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_POST(self):
+        if self.path != '/event':
+            return self.send_text(404, 'Not Found')
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.server.token):
+            LOG.warn('Refused event from %s without the cluster token', self.address_string())
+            return self.send_text(403, 'Forbidden')
+        try:
+            length = int(self.headers.get('Content-Length'))
+            if length < 0:
+                raise ValueError(length)
+            event = json.loads(self.rfile.read(length))
+        except (TypeError, ValueError):
+            return self.send_text(400, 'Bad Request')
+        if not valid_event(event):
+            return self.send_text(400, 'Bad Request')
+        if not self.server.owns(event['project_name']):
+            # the members changed, the sender retries with the new owner
+            return self.send_text(409, 'Not Owner')
+        try:
+            # forwarded events are never forwarded again
+            self.server.queue.put(event, True, self.server.queue_timeout)
+        except Full:
+            return self.send_text(503, 'Busy')
+        self.send_text(200, 'OK')
+
+    def log_message(self, fmt, *args):
+        LOG.debug("%s - - [%s] %s",
+                  self.address_string(),
+                  self.log_date_time_string(),
+                  fmt % args)
+
+
+class ClusterHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ClusterServer(threading.Thread):
+    """ Takes events forwarded by other nodes and puts them in the local queue
+
+        Only events sent with the token and of projects owns() is True for
+        are taken.
+    """
+
+    def __init__(self, address, port, queue, token, owns, queue_timeout=5):
+        self.address = address
+        self.port = port
+        self.queue = queue
+        self.token = token
+        self.owns = owns
+        self.queue_timeout = queue_timeout
+        self.logger = LOG
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='cluster-server')
+
+    def run(self):
+        httpd = ClusterHTTPServer((self.address, self.port), ClusterHTTPHandler)
+        httpd.queue = self.queue
+        httpd.queue_timeout = self.queue_timeout
+        httpd.token = self.token
+        httpd.owns = self.owns
+        httpd.timeout = 2
+        self.logger.info('Taking forwarded events on %s:%s', self.address, self.port)
+        try:
+            while self.running:
+                httpd.handle_request()
+        except Exception as e:
+            logging.exception('Cluster server exception: %s', str(e))
+        finally:
+            httpd.socket.close()
@@ -0,0 +1,290 @@
+import logging
+import threading
+import itertools
+from time import time
+from collections import deque
+from Queue import Empty, Full
+
+from .metrics import METRICS
+from .trace import new_trace_id, record
+
+LOG = logging.getLogger('repowatch.queue')
+
+# live events come from the watchers, bulk work from discovery and reconciling
+LIVE = 'live'
+BULK = 'bulk'
+
+# every this many events handed out one is bulk work, if there is any
+DEFAULT_BULK_EVERY = 4
+
+
+def event_key(event):
+    '''
+    Returns the key of what an event acts on, (project, branch directory)
+
+    Events that are waiting in the queue with the same key replace each other,
+    events that should never be merged (like shutdown) return None. A
+    reconcile acts on the whole project like a delete without a branch.
+    '''
+    if event['type'] == 'reconcile':
+        return (event['project_name'], None)
+    if event['type'] == 'command':
+        # a project may be checked out in several places
+        return (event['project_name'], event['branch_dir'])
+    if event['type'] not in ('update', 'delete'):
+        return None
+    return (event['project_name'],
+            event.get('output_dir') or event.get('branch_name'))
+
+
+class CoalescingQueue(object):
+    '''
+    A FIFO queue that keeps only the newest pending event per branch
+
+    An update for a branch that already has an event waiting takes over the
+    place of the old one in line, a delete replaces any waiting update so that
+    only the delete is done. A delete without a branch (full cleanup of a project)
+    is merged with other waiting full cleanups of the same project.
+
+    Events are only handed out when nothing else is working on the same branch
+    directory, workers have to call done() with the event when finished. A full
+    cleanup of a project waits for all work on that project and blocks it while
+    running, branch events of the project behind it wait so that steady
+    traffic can not hold it up forever. Different projects and branches are
+    handed out in parallel.
+
+    With a maxsize put() blocks (or raises Full) while that many events are
+    waiting, events that merge into a waiting one and shutdown events are
+    always accepted.
+
+    project_limit is an optional function returning how many events of a
+    project may be worked on at once, 0 for no limit. Projects that are being
+    drained get no new events, see drain().
+
+    Events have a lane, event['lane'] is LIVE (the default) or BULK. Live
+    events are handed out first, but every bulk_every-th event is bulk work
+    when there is some that can run so a backlog still moves. 0 hands out
+    bulk work only when no live event can run. A live event that merges
+    into waiting bulk work moves it to the live lane.
+
+    With a journal (see journal.Journal) accepted events and their end, done
+    or merged or dropped, are recorded so unfinished work survives a restart.
+    '''
+
+    def __init__(self, maxsize=0, project_limit=None, bulk_every=DEFAULT_BULK_EVERY):
+        self.maxsize = maxsize
+        self.project_limit = project_limit
+        self.bulk_every = bulk_every
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.lanes = {LIVE: deque(), BULK: deque()}
+        self.since_bulk = 0
+        self.pending = dict()
+        self.active = set()
+        self.active_projects = dict()
+        self.merged = 0
+        self.draining = set()
+        self.journal = None
+        self._unique = itertools.count()
+
+    def _is_full(self):
+        return 0 < self.maxsize <= len(self.pending)
+
+    def put(self, event, block=True, timeout=None):
+        ''' Add an event, merging it with a waiting event for the same branch
+
+            returns True if it was merged
+        '''
+        with self.not_empty:
+            key = event_key(event)
+            if key is None:
+                key = ('__unique__', next(self._unique))
+            elif key[0] in self.draining:
+                LOG.debug('Dropped %s event for removed project %s', event['type'], key[0])
+                return False
+            elif key not in self.pending and self._is_full():
+                if not block:
+                    raise Full
+                endtime = None if timeout is None else time() + timeout
+                while key not in self.pending and self._is_full():
+                    if endtime is None:
+                        self.not_full.wait()
+                        continue
+                    remaining = endtime - time()
+                    if remaining <= 0.0:
+                        raise Full
+                    self.not_full.wait(remaining)
+
+            # when an event came in, kept from the oldest of merged events
+            event['received'] = self.pending[key].get('received', time()) if key in self.pending else time()
+            event.setdefault('trace_id', new_trace_id())
+
+            lane = event.setdefault('lane', LIVE)
+            if key in self.pending:
+                self.merged += 1
+                record(self.pending[key]['trace_id'], 'merged', time(), 0, merged_into=event['trace_id'])
+                LOG.debug('Merged %s event for %s:%s into waiting %s event (%s merged)',
+                          event['type'], key[0], key[1],
+                          self.pending[key]['type'], self.merged)
+                if self.pending[key]['lane'] != lane:
+                    if lane == BULK:
+                        # still wanted soon
+                        event['lane'] = LIVE
+                    else:
+                        self.lanes[BULK].remove(key)
+                        self.lanes[LIVE].append(key)
+            else:
+                self.lanes[lane].append(key)
+            merged = key in self.pending
+            if self.journal is not None and key[0] != '__unique__':
+                if merged:
+                    self.journal.finished(self.pending[key])
+                self.journal.added(event)
+            self.pending[key] = event
+            self.not_empty.notify()
+        # not with the mutex held, rendering the metrics takes the locks the other way around
+        METRICS.inc('repowatch_events_total', type=event['type'])
+        return merged
+
+    def _is_free(self, key):
+        ''' Nobody is working on the branch (or project for a full cleanup) '''
+        project, target = key
+        if project == '__unique__':
+            return True
+        if (project, None) in self.active:
+            return False
+        if target is None:
+            return self.active_projects.get(project, 0) == 0
+        if self.project_limit is not None:
+            limit = self.project_limit(project)
+            if limit and self.active_projects.get(project, 0) >= limit:
+                return False
+        return key not in self.active
+
+    def _next_key(self):
+        ''' Returns tuple (lane, key) of the next event that can run or None '''
+        if self.bulk_every and self.since_bulk >= self.bulk_every - 1:
+            lanes = (BULK, LIVE)
+        else:
+            lanes = (LIVE, BULK)
+        # a full cleanup that waits for its project, first in line or ahead of the
+        # project's branch events, holds those back so steady traffic can not starve it
+        waiting = set(queue[0][0] for queue in self.lanes.values()
+                      if queue and queue[0][1] is None and not self._is_free(queue[0]))
+        for lane in lanes:
+            for key in self.lanes[lane]:
+                if key[1] is not None and key[0] in waiting:
+                    continue
+                if self._is_free(key):
+                    return lane, key
+                if key[1] is None:
+                    waiting.add(key[0])
+        return None
+
+    def get(self, block=True, timeout=None):
+        '''
+        Remove and return the oldest waiting event that can run now,
+        raises Empty like Queue.get
+        '''
+        with self.not_empty:
+            found = self._next_key()
+            if not block:
+                if found is None:
+                    raise Empty
+            elif timeout is None:
+                while found is None:
+                    self.not_empty.wait()
+                    found = self._next_key()
+            else:
+                endtime = time() + timeout
+                while found is None:
+                    remaining = endtime - time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+                    found = self._next_key()
+            lane, key = found
+            self.lanes[lane].remove(key)
+            self.since_bulk = 0 if lane == BULK else self.since_bulk + 1
+            self.not_full.notify()
+            if key[0] != '__unique__':
+                self.active.add(key)
+                self.active_projects[key[0]] = self.active_projects.get(key[0], 0) + 1
+            return self.pending.pop(key)
+
+    def done(self, event):
+        ''' Mark an event returned by get() as finished '''
+        key = event_key(event)
+        if key is None:
+            return
+        with self.not_empty:
+            if key in self.active:
+                self.active.discard(key)
+                self.active_projects[key[0]] -= 1
+                if not self.active_projects[key[0]]:
+                    del self.active_projects[key[0]]
+            if self.journal is not None:
+                self.journal.finished(event)
+            self.not_empty.notify_all()
+
+    def discard(self, event):
+        ''' Drop the waiting event with the same key as event, returns it or None '''
+        key = event_key(event)
+        if key is None:
+            return None
+        with self.not_empty:
+            if key not in self.pending:
+                return None
+            self.lanes[self.pending[key]['lane']].remove(key)
+            self.not_full.notify()
+            if self.journal is not None:
+                self.journal.finished(self.pending[key])
+            return self.pending.pop(key)
+
+    def drain(self, project):
+        ''' Drop the waiting events of a project and refuse new ones until resume()
+
+            returns True when nothing of the project is being worked on anymore
+        '''
+        with self.not_empty:
+            self.draining.add(project)
+            for key in [k for k in self.pending if k[0] == project]:
+                event = self.pending.pop(key)
+                self.lanes[event['lane']].remove(key)
+                if self.journal is not None:
+                    self.journal.finished(event)
+            self.not_full.notify_all()
+            return project not in self.active_projects
+
+    def resume(self, project):
+        with self.mutex:
+            self.draining.discard(project)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def put_nowait(self, event):
+        return self.put(event, False)
+
+    def qsize(self):
+        with self.mutex:
+            return len(self.pending)
+
+    def lane_size(self, lane):
+        with self.mutex:
+            return len(self.lanes[lane])
+
+    def oldest_age(self):
+        ''' Seconds the event first in line has been waiting, 0 if none is '''
+        with self.mutex:
+            heads = [self.pending[lane[0]]['received'] for lane in self.lanes.values() if lane]
+        return time() - min(heads) if heads else 0.0
+
+    def active_count(self):
+        ''' Events being worked on '''
+        with self.mutex:
+            return len(self.active)
+
+    def empty(self):
+        return self.qsize() == 0
@@ -0,0 +1,93 @@
+import logging
+import threading
+from time import time
+from Queue import Empty
+
+from .metrics import METRICS
+from .trace import trace, span, current_trace_id
+from .eventqueue import CoalescingQueue
+from .util import run_user_cmd, KeyedLock
+
+LOG = logging.getLogger('repowatch.executor')
+
+
+class CommandExecutor(object):
+    '''
+    Runs the user commands of projects in threads of their own so slow or
+    hanging commands do not hold up checkouts
+
+    Commands waiting for a branch directory are replaced when that branch is
+    checked out again, only the commands for the newest checkout run. A
+    branch directory is not changed while its commands run, see branch_lock.
+
+    project_limit is an optional function returning how many commands of a
+    project may run at once, 0 for no limit.
+    '''
+
+    def __init__(self, project_limit=None):
+        self.queue = CoalescingQueue(project_limit=project_limit)
+        self.branch_lock = KeyedLock()
+
+    def submit(self, project_name, branch_name, output_dir, cmds, project_dir, branch_dir, timeout=None):
+        ''' Queue the commands for a checkout, replacing any still waiting for that directory '''
+        job = {'type': 'command',
+               'project_name': project_name,
+               'branch_name': branch_name,
+               'output_dir': output_dir,
+               'cmds': cmds,
+               'project_dir': project_dir,
+               'branch_dir': branch_dir,
+               'timeout': timeout}
+        trace_id = current_trace_id()
+        if trace_id is not None:
+            job['trace_id'] = trace_id
+        if self.queue.put(job):
+            self._dropped(project_name, branch_dir)
+
+    def cancel(self, project_name, branch_dir):
+        ''' Drop commands waiting for a directory that is about to change '''
+        if self.queue.discard({'type': 'command',
+                               'project_name': project_name,
+                               'branch_dir': branch_dir}) is not None:
+            self._dropped(project_name, branch_dir)
+
+    @staticmethod
+    def _dropped(project_name, branch_dir):
+        METRICS.inc('repowatch_commands_dropped_total', project=project_name)
+        LOG.info('Dropped waiting commands of %s in %s for a newer checkout', project_name, branch_dir)
+
+    def run_one(self, block=True, timeout=None):
+        ''' Run the next commands that may run, raises Empty like Queue.get '''
+        job = self.queue.get(block, timeout)
+        started = time()
+        METRICS.observe('repowatch_command_wait_seconds', started - job['received'])
+        try:
+            with self.branch_lock((job['project_name'], job['branch_dir'])):
+                with trace(job), span('user_cmd', project=job['project_name'], branch=job['output_dir']):
+                    run_user_cmd(job['cmds'], job['project_name'], job['branch_name'],
+                                 job['project_dir'], job['branch_dir'], job['timeout'])
+        finally:
+            self.queue.done(job)
+            METRICS.observe('repowatch_phase_seconds', time() - started,
+                            phase='user_cmd', project=job['project_name'])
+
+
+class CommandRunner(threading.Thread):
+    """ Runs user commands handed to a CommandExecutor """
+
+    def __init__(self, executor, name=None):
+        self.executor = executor
+        self.logger = LOG
+
+        self.running = True
+
+        threading.Thread.__init__(self, name=name)
+
+    def run(self):
+        while self.running:
+            try:
+                self.executor.run_one(True, 2)
+            except Empty:
+                pass
+            except Exception:
+                self.logger.exception('Error running user commands')
@@ -6,6 +6,20 @@ from os.path import basename, dirname
 
 import paramiko
 
+from .util import HOST_BUDGET
+
+# options of the config section that are passed on to paramiko
+CONNECT_OPTIONS = ('hostname', 'port', 'username', 'key_filename', 'timeout')
+
+# projects per gerrit query when looking for open changes
+EXTRA_BATCH = 50
+
+# seconds before the last seen event to start catching up from after a reconnect
+CATCH_UP_OVERLAP = 60
+
+# seconds between checks whether a standby node should read the stream
+STANDBY_CHECK = 5
+
 
 class WatchGerrit(threading.Thread):
     """ Threaded job; listens for Gerrit events and puts them in a queue """
@@ -18,58 +32,168 @@ class WatchGerrit(threading.Thread):
         self.queue = queue
         self.logger = logging.getLogger('repowatch.gerrit')
 
-        self.running = True
+        # eventCreatedOn of the newest event seen on the stream
+        self.last_event = None
 
-        threading.Thread.__init__(self)
+        self._session = None
+        self.session_lock = threading.Lock()
 
-    def get_extra(self, project):
-        """ Fetch list of extra refs to check out.
+        # connection of the event stream
+        self.client = None
 
-            returns tuple (ref, change_$number)
-        """
-        extra_refs = []
-        try:
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(**self.options)
-            _, stdout, _ = client.exec_command('gerrit query "status:open project:{0}" '
-                                               '--patch-sets --format json'.format(project))
-            for line in stdout:
-                # get
-                data = json.loads(line)
-                if data.get('status', None):
-                    extra_refs.append([data['patchSets'][-1:][0]['ref'],
-                                       'change_{0}'.format(data['number'])])
+        # function telling whether this node reads the stream, e.g. only the
+        # cluster leader, None always reads it
+        self.active = None
+        # seconds the node reading the stream may have been gone before this
+        # one takes over, like the cluster ttl, missed events are caught up
+        self.takeover_lag = 0
 
-        except Exception as e:
-            self.logger.exception('get_extra error: %s', str(e))
-        finally:
-            client.close()
+        self.running = True
 
-        self.logger.debug('Adding extra Gerrit refs: %s', extra_refs)
-        return extra_refs
+        threading.Thread.__init__(self)
+
+    def connect_options(self):
+        return dict((k, v) for k, v in self.options.items() if k in CONNECT_OPTIONS)
+
+    def connect(self):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with HOST_BUDGET(self.options['hostname']):
+            client.connect(**self.connect_options())
+        return client
+
+    def session(self):
+        """ Shared connection for queries, each query runs in its own channel """
+        with self.session_lock:
+            transport = self._session.get_transport() if self._session else None
+            if transport is None or not transport.is_active():
+                self._session = self.connect()
+            return self._session
+
+    def get_extra(self, projects):
+        """ Fetch extra refs to check out, the open changes of the projects.
+
+            Projects are queried in batches over one connection, yields an
+            update event per change with output_dir change_$number. Errors
+            are raised so callers do not mistake them for no open changes.
+        """
+        projects = list(projects)
+        for i in range(0, len(projects), EXTRA_BATCH):
+            batch = projects[i:i + EXTRA_BATCH]
+            query = 'status:open ({0})'.format(' OR '.join('project:{0}'.format(p) for p in batch))
+            for change in self.query(self.session(), query):
+                self.logger.debug('Adding extra Gerrit ref: %s', change['currentPatchSet']['ref'])
+                yield {'type': 'update',
+                       'project_name': change['project'],
+                       'branch_name': change['currentPatchSet']['ref'],
+                       'output_dir': 'change_{0}'.format(change['number']),
+                       'sha': change['currentPatchSet'].get('revision')}
+
+    def standby(self):
+        """ Wait while another node reads the stream, returns True if we waited """
+        if self.active is None or self.active():
+            return False
+        # when this node takes over it catches up from when the other one may have stopped
+        self.last_event = time.time() - self.takeover_lag
+        time.sleep(STANDBY_CHECK)
+        return True
+
+    def list_projects(self):
+        """ Names of all projects on the server, to find those that fit a pattern """
+        _, stdout, _ = self.session().exec_command('gerrit ls-projects')
+        return [line.strip() for line in stdout if line.strip()]
 
     def run(self):
         while self.running:
+            if self.standby():
+                continue
 
             try:
-                client = paramiko.SSHClient()
-                client.load_system_host_keys()
-                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                client.connect(**self.options)
+                client = None
+                client = self.client = self.connect()
                 client.get_transport().set_keepalive(60)
                 _, stdout, _ = client.exec_command('gerrit stream-events')
+                if self.last_event is not None:
+                    # the stream is already running so nothing falls in between
+                    self.catch_up(client, self.last_event)
                 for line in stdout:
                     # self.queue.put(json.loads(line))
                     self.handle_event(json.loads(line))
+                    if self.active is not None and not self.active():
+                        self.logger.info('Another node reads the event stream now')
+                        break
             except Exception as e:
-                logging.exception('WatchGerrit: error: %s', str(e))
+                if self.running:
+                    logging.exception('WatchGerrit: error: %s', str(e))
             finally:
-                client.close()
-            time.sleep(5)
+                if client:
+                    client.close()
+            if self.running:
+                time.sleep(5)
+
+    def stop(self):
+        """ End the event stream, e.g. when the config changed """
+        self.running = False
+        if self.client:
+            self.client.close()
+
+    def query(self, client, query, options='--current-patch-set'):
+        """ Run a gerrit query and yield the changes, following all pages of results """
+        start = 0
+        while True:
+            command = "gerrit query --format json {0} --start {1} '{2}'".format(options, start, query)
+            _, stdout, _ = client.exec_command(command)
+            more = False
+            for line in stdout:
+                data = json.loads(line)
+                if data.get('type') == 'stats':
+                    more = data.get('moreChanges', False)
+                    start += data.get('rowCount', 0)
+                else:
+                    yield data
+            if not more:
+                return
+
+    def catch_up(self, client, since):
+        """ Queue the changes that were updated while the stream was down
+
+            Branches that were pushed to directly, without a change, are not
+            found this way and are picked up by the next reconcile.
+        """
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since - CATCH_UP_OVERLAP))
+        count = 0
+        for change in self.query(client, 'after:"{0} +0000"'.format(stamp)):
+            self.handle_change(change)
+            count += 1
+        self.logger.info('Caught up on %s changes updated since %s UTC', count, stamp)
+
+    def put(self, event):
+        """ Queue an event, marked as one of a Gerrit project """
+        event['project_type'] = 'gerrit'
+        self.queue.put(event)
+
+    def handle_change(self, change):
+        """ Queue the events for the current state of a change from gerrit query """
+        output_dir = 'change_{0}'.format(change['number'])
+        if change['status'] in ('NEW', 'DRAFT'):
+            self.put({'type': 'update',
+                      'project_name': change['project'],
+                      'branch_name': change['currentPatchSet']['ref'],
+                      'output_dir': output_dir,
+                      'sha': change['currentPatchSet'].get('revision')})
+        else:
+            self.put({'type': 'delete',
+                      'project_name': change['project'],
+                      'branch_name': output_dir})
+            if change['status'] == 'MERGED':
+                self.put({'type': 'update',
+                          'project_name': change['project'],
+                          'branch_name': change['branch']})
 
     def handle_event(self, event):
+        self.last_event = max(self.last_event or 0, event.get('eventCreatedOn', time.time()))
+
         try:
             event_project = event['change']['project']
         except KeyError:
@@ -81,26 +205,28 @@ class WatchGerrit(threading.Thread):
         if event['type'] in ['patchset-created',
                              'draft-published',
                              'change-restored']:
-            self.queue.put({'type': 'update',
-                            'project_name': event['change']['project'],
-                            'branch_name': event['patchSet']['ref'],
-                            'output_dir': 'change_{0}'.format(basename(dirname(event['patchSet']['ref'])))})
+            self.put({'type': 'update',
+                      'project_name': event['change']['project'],
+                      'branch_name': event['patchSet']['ref'],
+                      'output_dir': 'change_{0}'.format(basename(dirname(event['patchSet']['ref']))),
+                      'sha': event['patchSet'].get('revision')})
 
         # need to remove the branch_name directory that was created, a change-merged
         # also triggers a ref-updated event
         if event['type'] in ['change-abandoned',
                              'change-merged']:
-            self.queue.put({'type': 'delete',
-                            'project_name': event['change']['project'],
-                            'branch_name': 'change_{0}'.format(basename(dirname(event['patchSet']['ref'])))})
+            self.put({'type': 'delete',
+                      'project_name': event['change']['project'],
+                      'branch_name': 'change_{0}'.format(basename(dirname(event['patchSet']['ref'])))})
 
         # for ref updates, this needs to handle creating and deleting branch_namees and updating
         if event['type'] in ['ref-updated']:
             if event['refUpdate']['newRev'] == u'0000000000000000000000000000000000000000':
-                self.queue.put({'type': 'delete',
-                                'project_name': event['refUpdate']['project'],
-                                'branch_name': event['refUpdate']['refName']})
+                self.put({'type': 'delete',
+                          'project_name': event['refUpdate']['project'],
+                          'branch_name': event['refUpdate']['refName']})
             else:
-                self.queue.put({'type': 'update',
-                                'project_name': event['refUpdate']['project'],
-                                'branch_name': event['refUpdate']['refName']})
+                self.put({'type': 'update',
+                          'project_name': event['refUpdate']['project'],
+                          'branch_name': event['refUpdate']['refName'],
+                          'sha': event['refUpdate']['newRev']})
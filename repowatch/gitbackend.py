@@ -0,0 +1,251 @@
+import os
+import logging
+import threading
+import subprocess
+
+import paramiko
+
+try:
+    from dulwich.client import get_transport_and_path
+    from dulwich.repo import Repo
+    from dulwich.contrib.paramiko_vendor import _ParamikoWrapper
+except ImportError:
+    get_transport_and_path = None
+
+from .trace import span
+from .util import run_cmd, get_remote_heads
+
+LOG = logging.getLogger('repowatch.git')
+
+
+class SubprocessGit(object):
+    '''
+    Does git operations by running the git command line tool, the default
+
+    Every operation starts git, and git starts the ssh wrapper and ssh for
+    anything that talks to a server. Methods return False or None when the
+    operation failed, the error is logged.
+    '''
+
+    name = 'subprocess'
+
+    def __init__(self, wrapper, ssh_key=None):
+        self.wrapper = wrapper
+        self.ssh_key = ssh_key
+
+    def ls_remote(self, url):
+        ''' Returns the branches of a remote repository as [(branch, sha)] or None '''
+        output = run_cmd('git ls-remote --heads {0}'.format(url),
+                         wrapper=self.wrapper,
+                         ssh_key=self.ssh_key)
+        if output is False:
+            return None
+        return get_remote_heads(output)
+
+    def init(self, path, bare=False):
+        return run_cmd('git init --bare' if bare else 'git init', wrapper=self.wrapper, cwd=path)
+
+    def fetch(self, path, url, refspec, depth=None, tags=True, filter=None):
+        ''' Fetch refspec from url into the repository at path, FETCH_HEAD is the fetched commit
+
+            with a filter like blob:none this is a partial clone, objects
+            left out are fetched from url when git needs them
+        '''
+        cmd = 'git fetch '
+        if not tags:
+            cmd += '--no-tags '
+        if depth:
+            cmd += '--depth {0} '.format(depth)
+        if filter:
+            # a filter only works with a configured remote
+            self.promisor(path, url, filter)
+            cmd += '--filter={0} '.format(filter)
+            url = 'origin'
+        return run_cmd(cmd + '{0} {1}'.format(url, refspec),
+                       wrapper=self.wrapper,
+                       ssh_key=self.ssh_key,
+                       cwd=path) is not False
+
+    def checkout(self, path):
+        ''' Force the work tree at path to FETCH_HEAD, this fetches missing objects of a partial clone '''
+        return run_cmd('git checkout -f FETCH_HEAD ',
+                       wrapper=self.wrapper,
+                       ssh_key=self.ssh_key,
+                       cwd=path) is not False
+
+    @staticmethod
+    def get_config(path, key):
+        ''' Value of a git config key of the repository at path, None if it is not set '''
+        p = subprocess.Popen(['git', 'config', '--get', key], cwd=path,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = p.communicate()
+        return out.strip() if p.returncode == 0 else None
+
+    def set_config(self, path, values):
+        ''' Set git config values of the repository at path, only those that differ are written '''
+        for key, value in values:
+            if self.get_config(path, key) != value:
+                run_cmd('git config {0} {1}'.format(key, value), wrapper=None, cwd=path)
+
+    def promisor(self, path, url, filter):
+        ''' Make url the origin of a partial clone, git fetches what is missing from it '''
+        # the partialClone extension needs repository format 1
+        self.set_config(path, (('core.repositoryformatversion', '1'),
+                               ('extensions.partialClone', 'origin'),
+                               ('remote.origin.url', url),
+                               ('remote.origin.promisor', 'true'),
+                               ('remote.origin.partialclonefilter', filter)))
+
+    def sparse(self, path, patterns):
+        ''' Only check out files matching patterns (like .gitignore), None checks out everything '''
+        info = os.path.join(path, '.git', 'info')
+        sparse_file = os.path.join(info, 'sparse-checkout')
+        if not patterns and not os.path.isfile(sparse_file):
+            return
+        if not os.path.isdir(info):
+            os.makedirs(info)
+        content = '\n'.join(patterns or ['/*']) + '\n'
+        if os.path.isfile(sparse_file):
+            with open(sparse_file) as fh:
+                if fh.read() == content:
+                    return
+        # replaced rather than written into, it may be hardlinked
+        with open(sparse_file + '.new', 'w') as fh:
+            fh.write(content)
+        os.rename(sparse_file + '.new', sparse_file)
+        self.set_config(path, (('core.sparseCheckout', 'true'),))
+
+    def delete_ref(self, path, ref):
+        return run_cmd('git update-ref -d {0}'.format(ref), wrapper=self.wrapper, cwd=path)
+
+
+class PooledSSHVendor(object):
+    '''
+    Runs the git commands of dulwich over one paramiko connection per
+    user/host/port, like the ssh ControlMaster sockets of the subprocess
+    backend. Host keys have to be in the system known_hosts files.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = dict()
+
+    def client(self, host, port, username, key_filename):
+        key = (host, port, username, key_filename)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None or not client.get_transport() or not client.get_transport().is_active():
+                LOG.info('Connecting to %s@%s:%s', username, host, port)
+                client = paramiko.SSHClient()
+                client.load_system_host_keys()
+                client.set_missing_host_key_policy(paramiko.RejectPolicy())
+                client.connect(hostname=host, port=port or 22, username=username, key_filename=key_filename)
+                self.clients[key] = client
+            return client
+
+    def run_command(self, host, command, username=None, port=None, password=None, key_filename=None, **kwargs):
+        client = self.client(host, port, username, key_filename)
+        channel = client.get_transport().open_session()
+        channel.exec_command(command)
+        return _ParamikoWrapper(client, channel)
+
+
+class DulwichGit(SubprocessGit):
+    '''
+    Lists refs, fetches and changes refs in process with dulwich, ssh goes
+    through a pooled paramiko connection. Checkouts still run git, dulwich
+    cannot update an existing work tree. Tags are never fetched and fetches
+    from local repositories are never shallow, dulwich does not support that.
+    Partial clones are fetched with git.
+    '''
+
+    name = 'dulwich'
+
+    def __init__(self, wrapper, ssh_key=None):
+        if get_transport_and_path is None:
+            raise ImportError('git_backend = dulwich needs the dulwich package')
+        SubprocessGit.__init__(self, wrapper, ssh_key)
+        self.vendor = PooledSSHVendor()
+
+    def client(self, url):
+        ''' Returns tuple (dulwich client, path on the server) '''
+        if url.startswith('ssh://'):
+            return get_transport_and_path(url, vendor=self.vendor, key_filename=self.ssh_key)
+        client, path = get_transport_and_path(url)
+        # like git, try with .git added
+        if not os.path.exists(path) and os.path.exists(path + '.git'):
+            path += '.git'
+        return client, path
+
+    def ls_remote(self, url):
+        with span('ls_remote', url=url):
+            try:
+                client, path = self.client(url)
+                refs = client.get_refs(path)
+            except Exception as e:
+                LOG.error('Could not list refs of %s: %s', url, e)
+                return None
+        return [(ref[len('refs/heads/'):], sha) for ref, sha in sorted(refs.items())
+                if ref.startswith('refs/heads/')]
+
+    def init(self, path, bare=False):
+        if bare:
+            Repo.init_bare(path).close()
+        else:
+            Repo.init(path).close()
+        return True
+
+    def fetch(self, path, url, refspec, depth=None, tags=True, filter=None):
+        if filter:
+            # dulwich cannot do partial clones
+            return SubprocessGit.fetch(self, path, url, refspec, depth, tags, filter)
+        src, _, dst = refspec.lstrip('+').partition(':')
+        wanted = []
+        repo = Repo(path)
+
+        def determine_wants(refs):
+            sha = refs.get(src) or refs.get('refs/heads/' + src)
+            if sha is None:
+                return []
+            wanted.append(sha)
+            return [] if sha in repo.object_store else [sha]
+
+        try:
+            with span('fetch', url=url, ref=src):
+                client, remote_path = self.client(url)
+                if not url.startswith('ssh://'):
+                    depth = None
+                client.fetch(remote_path, repo, determine_wants, depth=depth)
+            if not wanted:
+                LOG.error('Could not find %s in %s', src, url)
+                return False
+            if dst:
+                repo.refs[dst] = wanted[0]
+            with open(os.path.join(repo.controldir(), 'FETCH_HEAD'), 'w') as fh:
+                fh.write("{0}\t\t'{1}' of {2}\n".format(wanted[0], src, url))
+        except Exception as e:
+            LOG.error('Could not fetch %s from %s: %s', src, url, e)
+            return False
+        finally:
+            repo.close()
+        return True
+
+    def delete_ref(self, path, ref):
+        repo = Repo(path)
+        try:
+            if ref in repo.refs:
+                del repo.refs[ref]
+        finally:
+            repo.close()
+        return True
+
+
+BACKENDS = dict((backend.name, backend) for backend in (SubprocessGit, DulwichGit))
+
+
+def get_backend(options, wrapper):
+    ''' The git backend selected by git_backend in a config section '''
+    name = options.get('git_backend', SubprocessGit.name)
+    if name not in BACKENDS:
+        raise ValueError('Unknown git_backend {0}, must be one of {1}'.format(name, sorted(BACKENDS)))
+    return BACKENDS[name](wrapper, options.get('key_filename', None))
@@ -2,44 +2,84 @@ import json
 import logging
 import threading
 from os.path import basename
+from Queue import Full
 
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 except ImportError:
     from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+DEFAULT_PORT = 8000
+# largest webhook body we accept, in bytes
+DEFAULT_MAX_BODY = 1024 * 1024
+# seconds to wait for room in a full event queue before answering 503
+DEFAULT_QUEUE_TIMEOUT = 5
 
 
 class GitlabHTTPHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        self.send_response(200)
+    # keep connections open between deliveries
+    protocol_version = 'HTTP/1.1'
+    # close idle keep-alive connections after this many seconds
+    timeout = 60
+
+    def send_text(self, code, text, headers=None):
+        self.send_response(code)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(text)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        # Send the html message
-        self.wfile.write("OK")
-        data_string = self.rfile.read(int(self.headers['Content-Length']))
-        self.handle_event(json.loads(data_string))
-        return
+        self.wfile.write(text)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.close_connection = 1
+            return self.send_text(411, 'Length Required')
+
+        if length < 0:
+            self.close_connection = 1
+            return self.send_text(400, 'Bad Request')
+
+        if length > self.server.max_body:
+            self.close_connection = 1
+            return self.send_text(413, 'Request Entity Too Large')
+
+        data_string = self.rfile.read(length)
+        try:
+            self.handle_event(json.loads(data_string))
+        except Full:
+            return self.send_text(503, 'Busy', {'Retry-After': '30'})
+        except (ValueError, KeyError, IndexError, TypeError):
+            return self.send_text(400, 'Bad Request')
+        self.send_text(200, 'OK')
 
     def handle_event(self, event):
         logger = logging.getLogger()
         logger.debug('Gitlab event: %s', event)
 
+        # older GitLab versions only send the ssh url of the repository
+        try:
+            project_name = event['project']['path_with_namespace']
+        except KeyError:
+            project_name = event['repository']['url'].split(':')[1][:-4]
+
         if event['after'] == u'0000000000000000000000000000000000000000':
-            self.server.queue.put({'type': 'delete',
-                                   'project_name': event['repository']['url'].split(':')[1][:-4],
-                                   'branch_name': basename(event['ref'])})
+            self.server.put({'type': 'delete',
+                             'project_name': project_name,
+                             'branch_name': basename(event['ref'])})
         else:
-            self.server.queue.put({'type': 'update',
-                                   'project_name': event['repository']['url'].split(':')[1][:-4],
-                                   'branch_name': basename(event['ref'])})
+            self.server.put({'type': 'update',
+                             'project_name': project_name,
+                             'branch_name': basename(event['ref']),
+                             'sha': event['after']})
 
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        # Send the html message
-        self.wfile.write("OK")
-        return
+        self.send_text(200, 'OK')
 
     def log_message(self, fmt, *args):
         logger = logging.getLogger('repowatch.gitlab')
@@ -49,11 +89,22 @@ class GitlabHTTPHandler(BaseHTTPRequestHandler):
                     fmt % args)
 
 
-class GitlabHTTPServer(HTTPServer):
-    def __init__(self, server_address, RequestHandlerClass, queue):
+class GitlabHTTPServer(ThreadingMixIn, HTTPServer):
+    """ Handles every connection in its own thread """
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, queue,
+                 max_body=DEFAULT_MAX_BODY, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
         self.queue = queue
+        self.max_body = max_body
+        self.queue_timeout = queue_timeout
         HTTPServer.__init__(self, server_address, RequestHandlerClass)
 
+    def put(self, event):
+        ''' Queue an event of a GitLab project, raises Queue.Full if there is no room in time '''
+        event['project_type'] = 'gitlab'
+        self.queue.put(event, True, self.queue_timeout)
+
 
 class WatchGitlab(threading.Thread):
     """ Starts HTTP server and listens for requests """
@@ -67,15 +118,26 @@ class WatchGitlab(threading.Thread):
 
         threading.Thread.__init__(self)
 
+    def stop(self):
+        """ Stop serving, within the 2 second request timeout """
+        self.running = False
+
     def get_extra(self, _):
         """ Get open issues? """
         return []
 
+    def list_projects(self):
+        """ Projects that fit a pattern are added by their first web hook """
+        return []
+
     def run(self):
-        port = 8000
-        httpd = GitlabHTTPServer(('', port), GitlabHTTPHandler, self.queue)
+        address = self.options.get('listen_address', '')
+        port = int(self.options.get('listen_port', DEFAULT_PORT))
+        httpd = GitlabHTTPServer((address, port), GitlabHTTPHandler, self.queue,
+                                 int(self.options.get('max_body', DEFAULT_MAX_BODY)),
+                                 float(self.options.get('queue_timeout', DEFAULT_QUEUE_TIMEOUT)))
         httpd.timeout = 2
-        self.logger.info('Starting HTTP server on %s', port)
+        self.logger.info('Starting HTTP server on %s:%s', address, port)
         try:
             # httpd.serve_forever()
             while self.running:
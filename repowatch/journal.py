@@ -0,0 +1,139 @@
+import os
+import json
+import logging
+import threading
+from time import sleep
+from collections import OrderedDict
+
+from .metrics import METRICS
+
+LOG = logging.getLogger('repowatch.journal')
+
+# the journal is rewritten with only the unfinished events when it has this
+# many more records than that
+DEFAULT_COMPACT_AT = 10000
+
+
+class Journal(threading.Thread):
+    """ Write-ahead journal of the events in the queue
+
+        Every accepted event is appended to the journal file as a JSON line,
+        and so is the end of every event. Records are buffered and written
+        with one fsync every sync_interval seconds. The file is compacted to
+        the unfinished events now and then, load() returns those after a
+        restart so they can be queued again.
+
+        added() and finished() are called by the queue with its mutex held,
+        so lock is only held to swap the buffer and the file, the writing
+        and syncing is done without it.
+    """
+
+    def __init__(self, path, sync_interval=0.1, compact_at=DEFAULT_COMPACT_AT):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_at = compact_at
+        self.logger = LOG
+
+        self.lock = threading.Lock()
+        # one sync at a time, the journal thread and close()
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.unfinished = OrderedDict()
+        self.records = 0
+        self.fh = None
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='journal')
+
+    def load(self):
+        ''' Returns the unfinished events of the journal file and starts a new file with them '''
+        if os.path.isfile(self.path):
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of a crash may be cut off
+                        self.logger.warn('Skipping bad journal line %r', line)
+                        continue
+                    if record['op'] == 'put':
+                        self.unfinished[record['id']] = record['event']
+                    else:
+                        self.unfinished.pop(record['id'], None)
+        # they stay unfinished in the new file until they are queued and done,
+        # queueing them again only adds another put record for the same id
+        events = list(self.unfinished.values())
+        self.logger.info('Replaying %s unfinished events from %s', len(events), self.path)
+        self._rewrite()
+        return events
+
+    def added(self, event):
+        with self.lock:
+            self.unfinished[event['trace_id']] = event
+            self.buffer.append(json.dumps({'op': 'put', 'id': event['trace_id'], 'event': event}))
+
+    def finished(self, event):
+        with self.lock:
+            if self.unfinished.pop(event.get('trace_id'), None) is not None:
+                self.buffer.append(json.dumps({'op': 'done', 'id': event['trace_id']}))
+
+    def sync(self):
+        ''' Write the buffered records and fsync them '''
+        with self.write_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                if self.fh is None and lines:
+                    self.fh = open(self.path, 'a')
+                fh = self.fh
+                compact = self.records + len(lines) > len(self.unfinished) + self.compact_at
+            if lines:
+                fh.write('\n'.join(lines) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+                self.records += len(lines)
+            if compact:
+                self._rewrite()
+        if lines:
+            METRICS.inc('repowatch_journal_records_total', len(lines))
+
+    def _rewrite(self):
+        ''' Replace the journal file with one holding only the unfinished events
+
+            Records buffered while the new file is written go into it with
+            the next sync, they may repeat what is in it already which
+            load() does not mind.
+        '''
+        with self.lock:
+            unfinished = list(self.unfinished.items())
+        tmp = self.path + '.new'
+        with open(tmp, 'w') as fh:
+            for trace_id, event in unfinished:
+                fh.write(json.dumps({'op': 'put', 'id': trace_id, 'event': event}) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        with self.lock:
+            os.rename(tmp, self.path)
+            old, self.fh = self.fh, open(self.path, 'a')
+        if old is not None:
+            old.close()
+        self.records = len(unfinished)
+        self.logger.debug('Compacted journal to %s events', self.records)
+
+    def run(self):
+        while self.running:
+            sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception:
+                self.logger.exception('Error writing the journal')
+
+    def close(self):
+        self.running = False
+        if self.is_alive():
+            self.join(5)
+        self.sync()
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
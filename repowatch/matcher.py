@@ -0,0 +1,154 @@
+import re
+import fnmatch
+import threading
+from os.path import basename
+
+# characters that make a project name in projects.yaml a glob pattern
+GLOB_CHARS = '*?['
+
+
+def is_pattern(name):
+    return any(c in name for c in GLOB_CHARS)
+
+
+class ProjectIndex(dict):
+    '''
+    The projects by name, like a dict, plus patterns for projects that are
+    not listed one by one
+
+    A project entry with a glob in its name, like group/*, or with a regex
+    instead of a name matches every project it fits, its path is a template
+    with {project} (the full name) and {name} (the last part). Looking up a
+    name that is not listed finds the first pattern in file order that
+    matches and adds the project made from it, so new repositories are
+    picked up from their first event. Iterating only gives the projects
+    listed or found so far.
+
+    Globs are kept in a trie by the literal path segments before their first
+    wildcard, a lookup only tries the globs along the path of the name and
+    the regexes, so it costs about the same for ten or twenty thousand
+    listed projects. accept can turn names down, like projects another
+    cluster node owns.
+
+    Workers add projects found by patterns while other threads read the
+    index, so changes are made with lock held and iterating goes over a
+    copy of the names.
+    '''
+
+    def __init__(self, projects=(), accept=None):
+        dict.__init__(self, projects)
+        self.lock = threading.RLock()
+        self.accept = accept
+        self.patterns = []
+        self.trie = dict()
+        self.regexes = []
+
+    def add_pattern(self, data):
+        ''' Add a pattern entry of projects.yaml, with a glob project or a regex '''
+        order = len(self.patterns)
+        self.patterns.append(data)
+        if data.get('regex'):
+            self.regexes.append((order, re.compile(data['regex'] + r'\Z'), data))
+            return
+        node = self.trie
+        segments = data['project'].split('/')
+        while len(segments) > 1 and not is_pattern(segments[0]):
+            node = node.setdefault(segments.pop(0), dict())
+        node.setdefault(None, []).append((order, re.compile(fnmatch.translate(data['project'])), data))
+
+    def use_patterns(self, other):
+        ''' Take the patterns and accept of another index, e.g. a reloaded one '''
+        self.accept = other.accept
+        self.patterns = other.patterns
+        self.trie = other.trie
+        self.regexes = other.regexes
+
+    def types(self):
+        ''' The project types listed or in patterns '''
+        return set(data['type'] for data in self.values() + self.patterns)
+
+    def filter(self, accept):
+        ''' A copy with only the projects accept takes, now and when found by patterns '''
+        index = ProjectIndex((name, data) for name, data in self.items() if accept(name))
+        index.use_patterns(self)
+        index.accept = accept
+        return index
+
+    def match(self, name, type=None):
+        ''' The entry of the first pattern name fits, of that type if given, or None '''
+        candidates = list(self.regexes)
+        node = self.trie
+        for segment in name.split('/'):
+            candidates.extend(node.get(None, ()))
+            node = node.get(segment)
+            if node is None:
+                break
+        else:
+            candidates.extend(node.get(None, ()))
+        for _, regex, data in sorted(candidates, key=lambda candidate: candidate[0]):
+            if (type is None or data['type'] == type) and regex.match(name):
+                return data
+        return None
+
+    def lookup(self, name, type=None):
+        ''' The project called name, added from a pattern if it fits one, or None '''
+        data = dict.get(self, name)
+        if data is not None or (self.accept is not None and not self.accept(name)):
+            return data
+        pattern = self.match(name, type)
+        if pattern is None:
+            return None
+        data = dict((k, v) for k, v in pattern.items() if k != 'regex')
+        data['project'] = name
+        data['path'] = pattern['path'].format(project=name, name=basename(name))
+        if 'destinations' in pattern:
+            data['destinations'] = [dict(d, path=d['path'].format(project=name, name=basename(name)))
+                                    for d in pattern['destinations']]
+        data['pattern'] = pattern.get('regex') or pattern['project']
+        with self.lock:
+            # another thread may have added it meanwhile
+            return dict.setdefault(self, name, data)
+
+    def __setitem__(self, name, data):
+        with self.lock:
+            dict.__setitem__(self, name, data)
+
+    def __delitem__(self, name):
+        with self.lock:
+            dict.__delitem__(self, name)
+
+    def pop(self, name, *default):
+        with self.lock:
+            return dict.pop(self, name, *default)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            dict.update(self, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return dict.keys(self)
+
+    def values(self):
+        with self.lock:
+            return dict.values(self)
+
+    def items(self):
+        with self.lock:
+            return dict.items(self)
+
+    def __missing__(self, name):
+        data = self.lookup(name)
+        if data is None:
+            raise KeyError(name)
+        return data
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def get(self, name, default=None):
+        data = self.lookup(name)
+        return default if data is None else data
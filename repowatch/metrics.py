@@ -0,0 +1,180 @@
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LOG = logging.getLogger('repowatch.metrics')
+
+# upper bounds in seconds, everything from a quick checkout to a long build
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Metrics(object):
+    '''
+    Counters, gauges and histograms kept in memory and rendered in the
+    Prometheus text format
+
+    Labels are given as keyword arguments, e.g.
+    METRICS.inc('repowatch_events_total', type='update')
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = dict()
+        self.types = dict()
+        self.values = dict()
+        self.histograms = dict()
+        self.functions = dict()
+
+    def describe(self, name, kind, text):
+        self.types[name] = kind
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def set_function(self, name, function):
+        ''' Value of name is read from function() when rendering '''
+        with self.lock:
+            self.functions[name] = function
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts, total, count = self.histograms.get(key, ([0] * len(BUCKETS), 0.0, 0))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            self.histograms[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        ''' Observe how long the with block took '''
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start, **labels)
+
+    def render(self):
+        lines = []
+        # read without the lock, the functions take locks of their own
+        # that are held by code that updates metrics
+        with self.lock:
+            functions = dict(self.functions)
+        readings = dict()
+        for name, function in functions.items():
+            try:
+                readings[name] = function()
+            except Exception:
+                LOG.exception('Error reading metric %s', name)
+        with self.lock:
+            names = set(name for name, _ in self.values)
+            names |= set(name for name, _ in self.histograms)
+            names |= set(functions)
+            for name in sorted(names):
+                if name in self.help:
+                    lines.append('# HELP {0} {1}'.format(name, self.help[name]))
+                    lines.append('# TYPE {0} {1}'.format(name, self.types[name]))
+                if name in readings:
+                    lines.append('{0} {1}'.format(name, readings[name]))
+                for (key_name, labels), value in sorted(self.values.items()):
+                    if key_name == name:
+                        lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+                for (key_name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, bucket in zip(BUCKETS, counts) + [('+Inf', count)]:
+                        bucket_labels = format_labels(labels + (('le', bound),))
+                        lines.append('{0}_bucket{1} {2}'.format(name, bucket_labels, bucket))
+                    lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), total))
+                    lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+# shared by everything in the daemon
+METRICS = Metrics()
+METRICS.describe('repowatch_queue_depth', 'gauge', 'Events waiting in the queue')
+METRICS.describe('repowatch_queue_bulk_depth', 'gauge', 'Discovery and reconcile events waiting in the queue')
+METRICS.describe('repowatch_queue_merged_total', 'counter', 'Events merged into a waiting event')
+METRICS.describe('repowatch_events_total', 'counter', 'Events put in the queue')
+METRICS.describe('repowatch_event_wait_seconds', 'histogram', 'Time from receiving an event until a worker takes it')
+METRICS.describe('repowatch_event_age_seconds', 'histogram', 'Time from receiving an event until it is done')
+METRICS.describe('repowatch_phase_seconds', 'histogram', 'Time spent in each phase of handling an event')
+METRICS.describe('repowatch_subprocess_total', 'counter', 'Commands run')
+METRICS.describe('repowatch_subprocess_failures_total', 'counter', 'Commands that returned nonzero')
+METRICS.describe('repowatch_command_queue_depth', 'gauge', 'User commands waiting to run')
+METRICS.describe('repowatch_command_wait_seconds', 'histogram', 'Time from a checkout until its user commands start')
+METRICS.describe('repowatch_commands_dropped_total', 'counter', 'User commands dropped for a newer checkout')
+METRICS.describe('repowatch_journal_records_total', 'counter', 'Records written to the event journal')
+METRICS.describe('repowatch_cluster_forwarded_total', 'counter', 'Events sent to the node owning their project')
+METRICS.describe('repowatch_cluster_forward_failures_total', 'counter', 'Events the owning node did not take')
+METRICS.describe('repowatch_workers', 'gauge', 'Worker threads')
+METRICS.describe('repowatch_workers_busy', 'gauge', 'Worker threads handling an event')
+METRICS.describe('repowatch_worker_busy_seconds_total', 'counter', 'Time workers spent handling events')
+
+
+class MetricsHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.debug("%s - - [%s] %s",
+                  self.address_string(),
+                  self.log_date_time_string(),
+                  fmt % args)
+
+
+class MetricsServer(threading.Thread):
+    """ Serves the metrics over HTTP for Prometheus to scrape """
+
+    def __init__(self, address, port, metrics=METRICS):
+        self.address = address
+        self.port = port
+        self.metrics = metrics
+        self.logger = LOG
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='metrics')
+
+    def run(self):
+        httpd = HTTPServer((self.address, self.port), MetricsHTTPHandler)
+        httpd.metrics = self.metrics
+        httpd.timeout = 2
+        self.logger.info('Serving metrics on %s:%s', self.address, self.port)
+        try:
+            while self.running:
+                httpd.handle_request()
+        except Exception as e:
+            logging.exception('Metrics server exception: %s', str(e))
+        finally:
+            httpd.socket.close()
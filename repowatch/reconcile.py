@@ -0,0 +1,102 @@
+import os
+import uuid
+import shutil
+import logging
+import threading
+import Queue
+from time import time, sleep
+
+from .eventqueue import BULK
+
+# deleted branch directories are renamed to this before they are removed
+TRASH_PREFIX = '.trash-'
+
+
+class Reconciler(threading.Thread):
+    """ Queues full cleanups of projects, debounced and periodically
+
+        A project that is requested is cleaned up delay seconds after the first
+        request, further requests in that time are merged into the same cleanup.
+        Every interval seconds all projects are requested, 0 turns that off.
+    """
+
+    def __init__(self, queue, projects, delay=60, interval=3600):
+        self.queue = queue
+        self.projects = projects
+        self.delay = delay
+        self.interval = interval
+        self.logger = logging.getLogger('repowatch.reconcile')
+
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.next_run = time() + interval
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='reconciler')
+
+    def request(self, project_name):
+        with self.lock:
+            self.pending.setdefault(project_name, time() + self.delay)
+
+    def run(self):
+        while self.running:
+            sleep(1)
+            now = time()
+            if self.interval and now >= self.next_run:
+                self.logger.info('Reconciling all %s projects', len(self.projects))
+                for project_name in self.projects.keys():
+                    self.request(project_name)
+                self.next_run = now + self.interval
+
+            with self.lock:
+                due = [p for p, when in self.pending.items() if when <= now]
+                for project_name in due:
+                    del self.pending[project_name]
+
+            for project_name in due:
+                self.queue.put({'type': 'reconcile',
+                                'lane': BULK,
+                                'project_name': project_name})
+
+
+class Trash(threading.Thread):
+    """ Removes deleted branch directories in the background
+
+        Directories are renamed next to where they were first, which is
+        instant, and then removed by this thread so workers do not wait on
+        large rmtree calls.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.logger = logging.getLogger('repowatch.trash')
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='trash')
+
+    def move(self, path):
+        ''' Take path out of the way now and remove it later '''
+        trash_path = os.path.join(os.path.dirname(path.rstrip('/')),
+                                  TRASH_PREFIX + uuid.uuid4().hex)
+        try:
+            os.rename(path, trash_path)
+        except OSError as e:
+            self.logger.warn('Could not move %s to trash, removing it now: %s', path, e)
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        self.queue.put(trash_path)
+
+    def put(self, trash_path):
+        ''' Remove an already renamed directory, e.g. left over from a crash '''
+        self.queue.put(trash_path)
+
+    def run(self):
+        while self.running:
+            try:
+                trash_path = self.queue.get(True, 2)
+            except Queue.Empty:
+                continue
+            self.logger.debug('Removing %s', trash_path)
+            shutil.rmtree(trash_path, ignore_errors=True)
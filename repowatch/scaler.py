@@ -0,0 +1,115 @@
+import os
+import logging
+import threading
+from multiprocessing import cpu_count
+from time import time, sleep
+
+LOG = logging.getLogger('repowatch.scaler')
+
+
+class WorkerScaler(threading.Thread):
+    """ Grows and shrinks the worker threads with the work waiting
+
+        Every interval seconds the queue is looked at. When more events wait
+        than workers are idle and the first in line has waited up_age
+        seconds, workers are added, at most half as many again at a time.
+        When nothing has waited for idle_time seconds, half of the idle
+        workers stop. No workers are added while the load average per cpu
+        is over max_load.
+
+        counts are the workers per section, bounds() returns the smallest and
+        largest number of workers per section and resize(section, n) adds n
+        workers to a section, or stops -n.
+    """
+
+    def __init__(self, queue, counts, bounds, resize, interval=5, up_age=10, idle_time=60, max_load=1.0):
+        self.queue = queue
+        self.counts = counts
+        self.bounds = bounds
+        self.resize = resize
+        self.interval = interval
+        self.up_age = up_age
+        self.idle_time = idle_time
+        self.max_load = max_load
+        self.logger = LOG
+
+        self.idle_since = None
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='scaler')
+
+    @staticmethod
+    def load():
+        ''' One minute load average per cpu '''
+        return os.getloadavg()[0] / cpu_count()
+
+    def step(self):
+        bounds = self.bounds()
+        # sections whose options changed are brought within their bounds first
+        for section, (low, high) in bounds.items():
+            count = self.counts.get(section, 0)
+            if not low <= count <= high:
+                self.logger.info('Resizing %s workers %s -> %s to fit %s..%s',
+                                 section, count, min(max(count, low), high), low, high)
+                self.resize(section, min(max(count, low), high) - count)
+
+        waiting = self.queue.qsize()
+        age = self.queue.oldest_age()
+        total = sum(self.counts.get(section, 0) for section in bounds)
+        idle = total - self.queue.active_count()
+
+        if waiting > idle and age >= self.up_age:
+            self.idle_since = None
+            load = self.load()
+            if load > self.max_load:
+                self.logger.info('Not adding workers for %s waiting events, load is %.2f per cpu', waiting, load)
+                return
+            added = dict()
+            for _ in range(0, min(waiting - idle, max(1, total // 2))):
+                room = [s for s, (_, high) in bounds.items() if self.counts.get(s, 0) + added.get(s, 0) < high]
+                if not room:
+                    break
+                # the section furthest from its limit
+                section = min(room, key=lambda s: float(self.counts.get(s, 0) + added.get(s, 0)) / bounds[s][1])
+                added[section] = added.get(section, 0) + 1
+            if not added:
+                self.logger.debug('All sections have their most workers, %s events waiting', waiting)
+            for section, n in sorted(added.items()):
+                self.logger.info('Adding %s %s workers (%s -> %s), %s events waiting, oldest for %.1fs',
+                                 n, section, self.counts.get(section, 0), self.counts.get(section, 0) + n,
+                                 waiting, age)
+                self.resize(section, n)
+
+        elif waiting == 0 and idle > 0:
+            if self.idle_since is None:
+                self.idle_since = time()
+                return
+            if time() - self.idle_since < self.idle_time:
+                return
+            removed = dict()
+            for _ in range(0, max(1, idle // 2)):
+                room = [s for s, (low, _) in bounds.items() if self.counts.get(s, 0) - removed.get(s, 0) > low]
+                if not room:
+                    break
+                section = max(room, key=lambda s: self.counts.get(s, 0) - removed.get(s, 0))
+                removed[section] = removed.get(section, 0) + 1
+            for section, n in sorted(removed.items()):
+                self.logger.info('Stopping %s idle %s workers (%s -> %s), nothing waited for %ss',
+                                 n, section, self.counts.get(section, 0), self.counts.get(section, 0) - n,
+                                 int(time() - self.idle_since))
+                self.resize(section, -n)
+            # wait as long again before stopping more
+            self.idle_since = time()
+
+        else:
+            self.idle_since = None
+
+    def run(self):
+        self.logger.info('Scaling workers every %ss', self.interval)
+        while self.running:
+            sleep(self.interval)
+            try:
+                self.step()
+            except Exception:
+                self.logger.exception('Error scaling workers')
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import logging
+import threading
+from time import time
+
+LOG = logging.getLogger('repowatch.state')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS branches (
+    project TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    sha TEXT,
+    updated REAL NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (project, directory)
+)
+'''
+
+
+class BranchState(object):
+    '''
+    Records which branches are checked out where and at what sha
+
+    Kept in a SQLite database in the state directory so a restart only has
+    to look at branches that changed while we were not running. The database
+    is opened on first use so the file survives daemonizing.
+    '''
+
+    def __init__(self, state_dir):
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.path = os.path.join(state_dir, 'branches.db')
+        self.lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            LOG.info('Using branch state in %s', self.path)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            with self._db:
+                self._db.execute(SCHEMA)
+        return self._db
+
+    def get(self, project, directory):
+        ''' Returns the record for a branch directory as a dict or None '''
+        with self.lock:
+            row = self.db.execute('SELECT * FROM branches WHERE project = ? AND directory = ?',
+                                  (project, directory)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, project, directory, branch, sha, status):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO branches '
+                            '(project, directory, branch, sha, updated, status) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (project, directory, branch, sha, time(), status))
+
+    def remove(self, project, directory):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM branches WHERE project = ? AND directory = ?',
+                            (project, directory))
+
+    def directories(self, project):
+        ''' All branch directories recorded for a project '''
+        with self.lock:
+            rows = self.db.execute('SELECT directory FROM branches WHERE project = ?',
+                                   (project,)).fetchall()
+        return [row[0] for row in rows]
+
+    def is_current(self, project, directory, sha):
+        ''' The directory was successfully checked out at sha '''
+        entry = self.get(project, directory)
+        return entry is not None and entry['sha'] == sha and entry['status'] == 'ok'
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import uuid
+import logging
+import threading
+from time import time, sleep
+from contextlib import contextmanager
+
+# spans are written as one JSON object per line to this logger, see enable()
+LOG = logging.getLogger('repowatch.trace')
+LOG.propagate = False
+
+_local = threading.local()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def enable(trace_file):
+    ''' Write spans as JSON lines to trace_file, opened on the first span '''
+    handler = logging.FileHandler(trace_file, delay=True)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    LOG.addHandler(handler)
+    LOG.setLevel(logging.INFO)
+
+
+def enabled():
+    return bool(LOG.handlers)
+
+
+def record(trace_id, name, start, duration, **attrs):
+    ''' Write one span '''
+    if not enabled():
+        return
+    attrs.update(trace_id=trace_id,
+                 span=name,
+                 start=round(start, 6),
+                 duration=round(duration, 6),
+                 thread=threading.current_thread().name)
+    LOG.info(json.dumps(attrs, sort_keys=True))
+
+
+@contextmanager
+def trace(event):
+    ''' Spans in the with block belong to the trace of event '''
+    _local.trace_id = event.get('trace_id')
+    try:
+        yield
+    finally:
+        _local.trace_id = None
+
+
+def current_trace_id():
+    ''' Trace id of the event this thread is working on, or None '''
+    return getattr(_local, 'trace_id', None)
+
+
+@contextmanager
+def span(name, **attrs):
+    ''' Time the with block as part of the current trace, if there is one
+
+        the attributes are given to the block to add to
+    '''
+    trace_id = current_trace_id()
+    if trace_id is None or not enabled():
+        yield attrs
+        return
+    start = time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = repr(e)
+        raise
+    finally:
+        record(trace_id, name, start, time() - start, **attrs)
+
+
+class Sampler(threading.Thread):
+    """ Samples the stacks of all threads to find where time goes
+
+        Every interval seconds the current frame of every other thread is
+        counted, on stop() the counts are written to output in the folded
+        format (frame;frame;frame count) used by flame graph tools.
+    """
+
+    def __init__(self, output, interval=0.01, depth=40):
+        self.output = output
+        self.interval = interval
+        self.depth = depth
+        self.counts = dict()
+        self.logger = logging.getLogger('repowatch.profile')
+
+        self.running = True
+
+        threading.Thread.__init__(self, name='profiler')
+
+    def sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append('{0}:{1}:{2}'.format(os.path.basename(code.co_filename),
+                                                  code.co_name,
+                                                  frame.f_lineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def run(self):
+        self.logger.info('Sampling stacks every %ss', self.interval)
+        while self.running:
+            self.sample()
+            sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join(5)
+        with open(self.output, 'w') as fh:
+            for key, count in sorted(self.counts.items(), key=lambda kv: -kv[1]):
+                fh.write('{0} {1}\n'.format(key, count))
+        self.logger.info('Wrote %s stack samples to %s', sum(self.counts.values()), self.output)
@@ -1,8 +1,14 @@
 import os
+import signal
+import shutil
 import tempfile
 import subprocess
 import stat
 import logging
+import threading
+
+from .metrics import METRICS
+from .trace import span
 
 LOG = logging.getLogger('repowatch.util')
 
@@ -10,26 +16,145 @@ GIT_SSH_WRAPPER = '''#!/bin/sh
 
 if [ -z "$PKEY" ]; then
     # if PKEY is not specified, run ssh using default keyfile
-    ssh "$@"
+    ssh {0}"$@"
 else
-    ssh -oStrictHostKeyChecking=no -i "$PKEY" "$@"
+    ssh {0}-oStrictHostKeyChecking=no -i "$PKEY" "$@"
 fi
 '''
 
+# shares one ssh connection per user/host/port between git commands, the
+# master connection stays around for persist seconds after the last command.
+# The master is started on its own with its output going nowhere, started by
+# a git command it would keep that command's stderr open while it runs.
+GIT_SSH_MULTIPLEX_WRAPPER = '''#!/bin/sh
 
-def get_remote_branches(output):
-    branches = []
+if [ -n "$PKEY" ]; then
+    # if PKEY is specified, use it instead of the default keyfile
+    set -- -oStrictHostKeyChecking=no -i "$PKEY" "$@"
+fi
+
+if ! ssh -oControlPath={path} -O check "$@" >/dev/null 2>&1; then
+    (
+        flock 9
+        ssh -oControlPath={path} -O check "$@" >/dev/null 2>&1 ||
+            ssh -oControlPath={path} -oControlMaster=yes -oControlPersist={persist} -Nf "$@" \\
+                </dev/null >/dev/null 2>&1
+    ) 9>{lock}
+fi
+exec ssh -oControlPath={path} -oControlMaster=no "$@"
+'''
+
+# max ssh connections at once per host, below the sshd MaxStartups default of 10
+DEFAULT_SSH_PER_HOST = 10
+
+
+def to_bool(value):
+    ''' Config values are strings, treat "False", "no", "0" and "off" as False '''
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('', 'false', 'no', '0', 'off')
+    return bool(value)
+
+
+class KeyedLock(object):
+    '''
+    Hands out one lock per key, used as: with keyed_lock(key):
+    '''
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = dict()
+
+    def __call__(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class HostSlots(object):
+    '''
+    Limits how many connections are made to a host at once, used as:
+    with host_slots(hostname):
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self._guard = threading.Lock()
+        self._slots = dict()
+
+    def __call__(self, hostname):
+        with self._guard:
+            return self._slots.setdefault(hostname, threading.BoundedSemaphore(self.limit))
+
+
+# shared by everything that connects to a git server, see RepoWatch.setup
+HOST_BUDGET = HostSlots(DEFAULT_SSH_PER_HOST)
+
+
+def remote_url(options, project_name, suffix=''):
+    '''
+    URL of a project on the server described by a config section
+
+    The url option of the section overrides the default ssh URL, it can use
+    {username}, {hostname}, {port} and {project}, e.g. file:///srv/git/{project}
+    '''
+    template = options.get('url', 'ssh://{username}@{hostname}:{port}/{project}')
+    return template.format(username=options.get('username'),
+                           hostname=options.get('hostname'),
+                           port=options.get('port'),
+                           project=project_name) + suffix
+
+
+def get_remote_heads(output):
+    ''' Parse git ls-remote --heads output into a list of (branch, sha) '''
+    heads = []
     for remote_head_str in output.rstrip('\n').split('\n'):
         try:
-            branch = remote_head_str.split('\t')[1][11:]
-            branches.append(branch)
-        except IndexError:
+            sha, ref = remote_head_str.split('\t')
+            heads.append((ref[11:], sha))
+        except ValueError:
             LOG.debug('Bad remote head: %s', remote_head_str)
-    return branches
+    return heads
+
+
+def get_remote_branches(output):
+    return [branch for branch, _ in get_remote_heads(output)]
+
+
+def read_head(path):
+    '''
+    Returns the sha checked out in the repository at path
+
+    Checkouts are done on FETCH_HEAD so HEAD is detached and holds the sha,
+    reading it does not need to start git. Returns None if it is unknown.
+    '''
+    try:
+        with open(os.path.join(path, '.git', 'HEAD')) as fh:
+            head = fh.read().strip()
+    except IOError:
+        return None
+    if len(head) == 40 and not head.startswith('ref:'):
+        return head
+    return None
+
+
+def command_label(cmd):
+    ''' Short name of a command for metrics, like "git fetch" or "make" '''
+    words = cmd.split()
+    return ' '.join(words[:2]) if words[0] == 'git' else words[0]
 
 
-def run_cmd(cmd, wrapper, ssh_key=None, **kwargs):
-    ''' Run the command and return stdout '''
+def kill_process_group(p, cmd, timeout):
+    ''' Kill a command started with its own process group and everything it started '''
+    LOG.error('Killing %s, still running after %ss', repr(cmd), timeout)
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run_cmd(cmd, wrapper, ssh_key=None, timeout=None, **kwargs):
+    ''' Run the command and return stdout
+
+        with a timeout in seconds the command is started in a process group of
+        its own which is killed when the time is up
+    '''
     LOG.debug('Running {0}'.format(cmd))
 
     env_dict = os.environ.copy()
@@ -41,14 +166,30 @@ def run_cmd(cmd, wrapper, ssh_key=None, **kwargs):
     if ssh_key:
         env_dict['PKEY'] = ssh_key
 
-    p = subprocess.Popen(cmd.split(),
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT,
-                         env=env_dict,
-                         **kwargs)
-    out, _ = p.communicate()
-    out = out.strip()
+    if timeout:
+        kwargs['preexec_fn'] = os.setsid
+
+    with span('run_cmd', command=cmd) as attrs:
+        p = subprocess.Popen(cmd.split(),
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             env=env_dict,
+                             **kwargs)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill_process_group, (p, cmd, timeout))
+            timer.daemon = True
+            timer.start()
+        try:
+            out, _ = p.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        out = out.strip()
+        attrs['returncode'] = p.returncode
+    METRICS.inc('repowatch_subprocess_total', command=command_label(cmd))
     if p.returncode != 0:
+        METRICS.inc('repowatch_subprocess_failures_total', command=command_label(cmd))
         LOG.error("Nonzero return code. "
                   "Code %s, Exec: %s, "
                   "Output: %s",
@@ -59,10 +200,12 @@ def run_cmd(cmd, wrapper, ssh_key=None, **kwargs):
     return out
 
 
-def run_user_cmd(cmds, project_name, branch_name, project_dir, branch_dir):
+def run_user_cmd(cmds, project_name, branch_name, project_dir, branch_dir, timeout=None):
     '''
     Allows specifying of commands in config for project
     to run after project is created or updated
+
+    timeout is in seconds per command
     '''
 
     varmap = {
@@ -78,15 +221,23 @@ def run_user_cmd(cmds, project_name, branch_name, project_dir, branch_dir):
 
     # run commands
     for command in cmds:
-        run_cmd(command, wrapper=None, cwd=branch_dir)
+        run_cmd(command, wrapper=None, cwd=branch_dir, timeout=timeout)
 
 
-def create_ssh_wrapper():
+def create_ssh_wrapper(control_dir=None, persist=60):
     '''
     Returns file name of location of SSH wrapper
+
+    With a control_dir ssh connections are multiplexed through sockets in it
     '''
+    if control_dir:
+        wrapper = GIT_SSH_MULTIPLEX_WRAPPER.format(path=os.path.join(control_dir, '%r@%h:%p'),
+                                                   persist=persist,
+                                                   lock=os.path.join(control_dir, '.lock'))
+    else:
+        wrapper = GIT_SSH_WRAPPER.format('')
     with tempfile.NamedTemporaryFile(prefix='tmp-GIT_SSH-wrapper-', delete=False) as fh:
-        fh.write(GIT_SSH_WRAPPER)
+        fh.write(wrapper)
         os.chmod(fh.name, stat.S_IRUSR | stat.S_IXUSR)
         # self.logger.debug('Created SSH wrapper: %s', fh.name)
         return fh.name
@@ -98,3 +249,18 @@ def cleanup_ssh_wrapper(wrapper):
         os.unlink(wrapper)
     except Exception as e:
         logging.exception('Error cleaning SSH wrapper')
+
+
+def create_ssh_control_dir():
+    ''' Directory for the ssh master sockets, kept short as socket paths are limited '''
+    return tempfile.mkdtemp(prefix='rw-ssh-')
+
+
+def cleanup_ssh_control_dir(control_dir):
+    ''' Stop the ssh master connections and remove their sockets '''
+    for name in os.listdir(control_dir):
+        if name.startswith('.'):
+            continue
+        run_cmd('ssh -oControlPath={0} -O exit repowatch'.format(os.path.join(control_dir, name)),
+                wrapper=None)
+    shutil.rmtree(control_dir, ignore_errors=True)
@@ -1,29 +1,75 @@
 import os
+import uuid
 import shutil
 import logging
+import subprocess
 import threading
+from time import time
+from contextlib import contextmanager
 from Queue import Empty
 
-from .util import run_cmd, run_user_cmd, get_remote_branches
+from .metrics import METRICS
+from .trace import trace, span
+from .reconcile import TRASH_PREFIX
+from .gitbackend import get_backend
+from .util import run_cmd, run_user_cmd, remote_url, read_head, to_bool, KeyedLock, HOST_BUDGET
 
 ONEYEAR = 365*24*60*60
 
+# fetches into the shared mirror of a project are done one at a time
+MIRROR_LOCKS = KeyedLock()
+
+# with atomic_publish branch directories are symlinks to checkouts in here
+GENERATIONS = '.generations'
+
+# checkouts kept per branch with atomic_publish, the published one included
+DEFAULT_PUBLISH_KEEP = 2
+
+# mirror in the project path of a project with several destinations and no mirror_dir
+MIRROR = '.mirror.git'
+
 
 class StopException(Exception):
     pass
 
 
+@contextmanager
+def phase(name, project_name):
+    ''' Time a phase of handling an event for the metrics and the trace '''
+    with METRICS.timer('repowatch_phase_seconds', phase=name, project=project_name):
+        with span(name, project=project_name):
+            yield
+
+
 class Worker(threading.Thread):
-    """ Waits for queue events and does the checkout and management """
+    """ Waits for queue events and does the checkout and management
 
-    def __init__(self, options, queue, ssh_wrapper, projects, lock):
+        options are the config sections by project type, all workers share one
+        queue so a worker handles projects of every type. With an executor user
+        commands are handed to it, otherwise they run in the worker. backends
+        are the git backends by project type, made from the options if missing.
+        section is the config section the worker was started for, it counts
+        towards that section's threads.
+    """
+
+    def __init__(self, options, queue, ssh_wrapper, projects, lock, state=None, trash=None, watchers=None,
+                 executor=None, backends=None, section=None):
         self.options = options
         self.queue = queue
         self.wrapper = ssh_wrapper
         self.projects = projects
         self.lock = lock
+        self.state = state
+        self.trash = trash
+        self.watchers = watchers or dict()
+        self.executor = executor
+        self.backends = backends if backends is not None else dict()
+        self.section_name = section
         self.logger = logging.getLogger('repowatch.worker')
 
+        # handling an event, idle workers are stopped first
+        self.busy = False
+
         self.running = True
 
         threading.Thread.__init__(self)
@@ -40,65 +86,324 @@ class Worker(threading.Thread):
                 self.logger.debug("Stopping")
                 self.running = False
 
-    def update_branch(self, project_name, branch_name, output_dir=None):
+    def section(self, project_name):
+        ''' Options of the server the project lives on '''
+        return self.options[self.projects[project_name]['type']]
+
+    def git(self, project_name):
+        ''' Git backend for the server the project lives on '''
+        project_type = self.projects[project_name]['type']
+        if project_type not in self.backends:
+            self.backends[project_type] = get_backend(self.options[project_type], self.wrapper)
+        return self.backends[project_type]
+
+    @contextmanager
+    def remote(self, project_name, needed=True):
+        ''' Take a connection slot for the server of the project, for git operations that talk to it '''
+        if not needed:
+            yield
+            return
+        hostname = self.section(project_name)['hostname']
+        slot = HOST_BUDGET(hostname)
+        with span('ssh_slot_wait', host=hostname):
+            slot.acquire()
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def update_branch(self, project_name, branch_name, output_dir=None, sha=None):
         ''' Do the actual branch update
 
             project_name: name of the repository project
             branch_name: name of the branch to checkout
             output_dir: directory to checkout branch into, defaults to branch_name
+            sha: commit the branch points to on the server, if known
 
         '''
         if output_dir is None:
             output_dir = branch_name
-        fullpath = self.projects[project_name]['path']+'/'+output_dir
-        project_type = self.projects[project_name]['type']
+        destinations = self.destinations(project_name)
+        stale = [d for d in destinations if sha is None or read_head(d['path']+'/'+output_dir) != sha]
 
-        try:
-            cmds = self.projects[project_name]['cmds']
-        except KeyError:
-            cmds = None
+        if not stale:
+            self.logger.debug('Branch %s:%s already at %s, skipping',
+                              project_name,
+                              branch_name,
+                              sha)
+            if self.state and not self.state.is_current(project_name, output_dir, sha):
+                self.state.record(project_name, output_dir, branch_name, sha, 'ok')
+            return
+
+        # fetched once, every destination checks out from the mirror
+        mirror = None
+        if self.uses_mirror(project_name):
+            mirror = self.update_mirror(project_name, branch_name, output_dir)
+
+        updated = []
+        for destination in stale:
+            path = destination['path']+'/'+output_dir
+            self.logger.info('Update repo branch: %s:%s in %s',
+                             project_name,
+                             branch_name,
+                             path)
+            with self.changing(project_name, path):
+                if to_bool(self.section(project_name).get('atomic_publish', False)):
+                    ok = self.publish(project_name, branch_name, output_dir, path, destination, mirror)
+                else:
+                    ok = self.checkout(project_name, branch_name, output_dir, path, destination, mirror)
+            if ok:
+                updated.append(path)
+
+        if self.state:
+            # every destination got the same fetch, the state has what was checked out
+            self.state.record(project_name, output_dir, branch_name,
+                              read_head(updated[0]) if updated else None,
+                              'ok' if len(updated) == len(stale) else 'failed')
+
+        # run user defined commands
+        timeout = int(self.section(project_name).get('command_timeout', 0)) or None
+        for destination in stale:
+            cmds = destination.get('cmds')
+            if not cmds:
+                continue
+            project_dir = destination['path']
+            path = project_dir+'/'+output_dir
+            if self.executor is not None:
+                self.executor.submit(project_name, branch_name, output_dir, cmds, project_dir, path, timeout)
+                continue
+            with self.lock(project_name):
+                with phase('user_cmd', project_name):
+                    run_user_cmd(cmds, project_name, branch_name, project_dir, path, timeout)
+
+    def destinations(self, project_name):
+        ''' Where the branches of a project are checked out, the project itself is the first
+
+            every destination has a path and may have its own cmds and sparse
+        '''
+        project = self.projects[project_name]
+        return [project] + project.get('destinations', [])
+
+    @contextmanager
+    def changing(self, project_name, branch_dir):
+        ''' Keep user commands out of a branch directory while it changes
+
+            commands still waiting for the directory are dropped, a newer
+            checkout queues its own
+        '''
+        if self.executor is None:
+            yield
+            return
+        self.executor.cancel(project_name, branch_dir)
+        with self.executor.branch_lock((project_name, branch_dir)):
+            yield
+
+    @staticmethod
+    def generations_path(project_dir, output_dir):
+        return os.path.join(project_dir, GENERATIONS, output_dir)
 
-        self.logger.info('Update repo branch: %s:%s in %s',
-                         project_name,
-                         branch_name,
-                         fullpath)
+    def stage(self, project_name, fullpath, new):
+        ''' Make new a copy of the checkout at fullpath, returns True if it worked
 
+            Tracked files and git objects are hardlinked, git replaces them
+            rather than writing into them. The rest of .git and untracked
+            files, like what user commands write, are copied because they are
+            changed in place.
+        '''
+        source = os.path.realpath(fullpath)
+        objects = os.path.join('.git', 'objects') + os.sep
+        with phase('stage', project_name):
+            try:
+                tracked = self.tracked_files(source)
+                for root, dirs, files in os.walk(source):
+                    relative = os.path.relpath(root, source)
+                    target = os.path.normpath(os.path.join(new, relative))
+                    os.mkdir(target)
+                    shutil.copymode(root, target)
+                    for name in dirs + files:
+                        path = os.path.normpath(os.path.join(relative, name))
+                        if os.path.islink(os.path.join(root, name)):
+                            os.symlink(os.readlink(os.path.join(root, name)), os.path.join(target, name))
+                        elif name in dirs:
+                            continue
+                        elif path in tracked or (path.startswith(objects) and
+                                                 not path.startswith(os.path.join(objects, 'info'))):
+                            os.link(os.path.join(root, name), os.path.join(target, name))
+                        else:
+                            shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+                return True
+            except (OSError, IOError, subprocess.CalledProcessError) as e:
+                self.logger.error('Could not copy %s to %s, checking out from scratch: %s', fullpath, new, e)
+        if os.path.exists(new):
+            self.remove(new)
+        return False
+
+    @staticmethod
+    def tracked_files(path):
+        ''' Paths of the files git tracks in the checkout at path '''
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['git', 'ls-files', '-z'], cwd=path, stderr=devnull)
+        return set(os.path.normpath(name) for name in output.split('\0') if name)
+
+    def publish(self, project_name, branch_name, output_dir, fullpath, destination=None, mirror=None):
+        ''' Check out a branch next to the published one and switch the symlink at fullpath to it
+
+            The new checkout starts as a copy of the published one that
+            hardlinks what git replaces rather than writes into, see stage(),
+            so the published tree is never touched. Returns True if the new
+            checkout was published.
+        '''
+        project_dir = (destination or self.projects[project_name])['path']
+        generations = self.generations_path(project_dir, output_dir)
+        new = os.path.join(generations, '{0:d}-{1}'.format(int(time() * 1000), uuid.uuid4().hex[:8]))
+        if not os.path.isdir(generations):
+            os.makedirs(generations)
+
+        if not (os.path.isdir(fullpath) and self.stage(project_name, fullpath, new)):
+            os.makedirs(new)
+            self.git(project_name).init(new)
+        if not os.path.islink(fullpath):
+            # hardlinking changes the ctime of every file, git should not take that as a change
+            run_cmd('git config core.trustctime false', wrapper=None, cwd=new)
+
+        if not self.checkout(project_name, branch_name, output_dir, new, destination, mirror):
+            self.remove(new)
+            return False
+
+        if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+            self.logger.info('Moving %s to a published checkout', fullpath)
+            self.remove(fullpath)
+        link = os.path.join(os.path.dirname(fullpath), '.{0}.{1}'.format(os.path.basename(fullpath),
+                                                                         uuid.uuid4().hex[:8]))
+        os.symlink(os.path.relpath(new, os.path.dirname(fullpath)), link)
+        os.rename(link, fullpath)
+
+        # older checkouts may still be read for a while, keep a few
+        keep = int(self.section(project_name).get('publish_keep', DEFAULT_PUBLISH_KEEP))
+        old = sorted(name for name in os.listdir(generations)
+                     if not name.startswith('.') and os.path.join(generations, name) != new)
+        for name in old[:max(0, len(old) - keep + 1)]:
+            self.remove(os.path.join(generations, name))
+        return True
+
+    def remove(self, path):
+        ''' Remove a directory, in the background if there is a trash '''
+        if self.trash:
+            self.trash.move(path)
+        else:
+            shutil.rmtree(path)
+
+    def checkout(self, project_name, branch_name, output_dir, fullpath, destination=None, mirror=None):
+        ''' Fetch a branch and check it out in fullpath, returns True if that worked
+
+            destination is the entry of the project to check out for, mirror
+            the (mirror path, ref) the branch was already fetched into
+        '''
+        git = self.git(project_name)
         if os.path.isdir(fullpath):
             if not os.path.isdir(os.path.join(fullpath, '.git')):
-                run_cmd('git init', wrapper=self.wrapper, cwd=fullpath)
+                git.init(fullpath)
         else:
             # create branch dir
             os.makedirs(fullpath)
-            run_cmd('git init', wrapper=self.wrapper, cwd=fullpath)
+            git.init(fullpath)
+
+        # partial clone and sparse checkout of what the project needs
+        project = self.projects[project_name]
+        blob_filter = project.get('filter')
+        git.sparse(fullpath, (destination or project).get('sparse'))
 
-        run_cmd('git fetch '
-                '--depth 1 '
-                'ssh://{0}@{1}:{2}/{3} {4}'.format(self.options['username'],
-                                                   self.options['hostname'],
-                                                   self.options['port'],
-                                                   project_name,
-                                                   branch_name),
-                wrapper=self.wrapper,
-                ssh_key=self.options.get('key_filename', None),
-                cwd=fullpath)
+        options = self.section(project_name)
+        if self.uses_mirror(project_name):
+            mirror, ref = mirror or self.update_mirror(project_name, branch_name, output_dir)
+            self.use_mirror_objects(fullpath, mirror)
+            if blob_filter:
+                # the mirror is partial too, what it lacks comes from the server
+                git.promisor(fullpath, remote_url(options, project_name), blob_filter)
+            # local fetch, all objects are already there through the alternates
+            with phase('fetch', project_name):
+                fetched = git.fetch(fullpath, mirror, ref, tags=False)
+        else:
+            with phase('fetch', project_name), self.remote(project_name):
+                fetched = git.fetch(fullpath, remote_url(options, project_name), branch_name, depth=1,
+                                    filter=blob_filter)
 
-        run_cmd('git checkout -f FETCH_HEAD ', wrapper=self.wrapper, cwd=fullpath)
+        # with a filter the checkout downloads the files it needs
+        with phase('checkout', project_name), self.remote(project_name, needed=bool(blob_filter)):
+            checked_out = git.checkout(fullpath)
 
-        # run user defined commands
-        if cmds:
-            with self.lock:
-                project_dir = self.projects[project_name]['path']
-                branch_dir = os.path.join(project_dir, branch_name)
-                run_user_cmd(cmds, project_name, branch_name, project_dir, branch_dir)
+        return fetched and checked_out
+
+    def uses_mirror(self, project_name):
+        ''' Branches are fetched into a mirror with mirror_dir or several destinations '''
+        return bool(self.section(project_name).get('mirror_dir') or self.projects[project_name].get('destinations'))
+
+    def mirror_path(self, project_name):
+        if not self.section(project_name).get('mirror_dir'):
+            return os.path.join(self.projects[project_name]['path'], MIRROR)
+        return os.path.join(self.section(project_name)['mirror_dir'], project_name + '.git')
+
+    def update_mirror(self, project_name, branch_name, output_dir):
+        ''' Fetch a branch into the bare mirror shared by all branches of a project
+
+            returns tuple (mirror path, ref the branch was fetched into)
+        '''
+        mirror = self.mirror_path(project_name)
+        ref = 'refs/repowatch/{0}'.format(output_dir)
+
+        git = self.git(project_name)
+        with MIRROR_LOCKS(project_name):
+            if not os.path.isdir(mirror):
+                os.makedirs(mirror)
+                git.init(mirror, bare=True)
+
+            # no depth here, history is downloaded once per project and shared
+            with phase('mirror_fetch', project_name), self.remote(project_name):
+                git.fetch(mirror,
+                          remote_url(self.section(project_name), project_name),
+                          '+{0}:{1}'.format(branch_name, ref),
+                          tags=False,
+                          filter=self.projects[project_name].get('filter'))
+        return mirror, ref
+
+    @staticmethod
+    def use_mirror_objects(fullpath, mirror):
+        ''' Point the branch checkout at the mirror objects like git clone --reference '''
+        info_dir = os.path.join(fullpath, '.git', 'objects', 'info')
+        alternates = os.path.join(info_dir, 'alternates')
+        objects = os.path.join(os.path.abspath(mirror), 'objects')
+        if os.path.isfile(alternates):
+            with open(alternates) as fh:
+                if objects in fh.read().split('\n'):
+                    return
+        if not os.path.isdir(info_dir):
+            os.makedirs(info_dir)
+        with open(alternates, 'a') as fh:
+            fh.write(objects + '\n')
 
     def delete_branch(self, project_name, branch_name):
-        fullpath = '{0}/{1}'.format(self.projects[project_name]['path'], branch_name)
-        if os.path.isdir(fullpath):
+        for destination in self.destinations(project_name):
+            fullpath = '{0}/{1}'.format(destination['path'], branch_name)
+            if not os.path.isdir(fullpath):
+                continue
             self.logger.info('Delete repo/branch: %s:%s at %s',
                              project_name,
                              branch_name,
                              fullpath)
-            shutil.rmtree(fullpath)
+            with self.changing(project_name, fullpath):
+                if os.path.islink(fullpath):
+                    os.unlink(fullpath)
+                    self.remove(self.generations_path(destination['path'], branch_name))
+                else:
+                    self.remove(fullpath)
+
+        if self.state:
+            self.state.remove(project_name, branch_name)
+
+        if self.uses_mirror(project_name) and os.path.isdir(self.mirror_path(project_name)):
+            with MIRROR_LOCKS(project_name):
+                self.git(project_name).delete_ref(self.mirror_path(project_name),
+                                                  'refs/repowatch/{0}'.format(branch_name))
 
     def cleanup_old_branches(self, project_name):
         """ delete local branches which don't exist upstream """
@@ -106,43 +411,89 @@ class Worker(threading.Thread):
             'Cleaning up local branches on project {0}'.format(project_name))
 
         data = self.projects[project_name]
-        remote = run_cmd('git ls-remote --heads '
-                         'ssh://{0}@{1}:{2}/{3}.git'.format(self.options['username'],
-                                                            self.options['hostname'],
-                                                            self.options['port'],
-                                                            project_name),
-                         wrapper=self.wrapper,
-                         ssh_key=self.options.get('key_filename', None))
+        with phase('ls_remote', project_name), self.remote(project_name):
+            remote = self.git(project_name).ls_remote(remote_url(self.section(project_name), project_name, '.git'))
         if remote:
-            project_path = data['path']
-            remote_branches = get_remote_branches(remote)
-            local_branches = [name for name in os.listdir(project_path)
-                              if os.path.isdir(os.path.join(project_path, name))]
-            for branch in local_branches:
+            remote_branches = [branch for branch, _ in remote]
+            # keep the checkouts of extra refs like open Gerrit changes
+            watcher = self.watchers.get(data['type'])
+            if watcher is not None:
+                try:
+                    remote_branches.extend(event['output_dir'] for event in watcher.get_extra([project_name]))
+                except Exception as e:
+                    self.logger.error('Not cleaning up %s, could not get extra refs: %s', project_name, e)
+                    return
+            # the state knows branches with a / in their name, the listing of
+            # every destination finds what was checked out before there was a state
+            local_branches = set(self.state.directories(project_name)) if self.state else set()
+            parents = set(branch.split('/')[0] for branch in list(local_branches) + remote_branches
+                          if '/' in branch)
+            for destination in self.destinations(project_name):
+                project_path = destination['path']
+                for name in os.listdir(project_path) if os.path.isdir(project_path) else []:
+                    if name.startswith(TRASH_PREFIX) and self.trash:
+                        # left over from before a restart
+                        self.trash.put(os.path.join(project_path, name))
+                    elif (not name.startswith('.') and name not in parents and
+                          os.path.isdir(os.path.join(project_path, name))):
+                        local_branches.add(name)
+            for branch in sorted(local_branches):
                 if branch not in (remote_branches):
                     self.delete_branch(project_name, branch)
+        elif remote is None and data.get('pattern'):
+            # found by a pattern, its next event adds it again if it comes back
+            self.logger.warn('Did not find remote heads for %s, forgetting it', project_name)
+            self.projects.pop(project_name, None)
         else:
             self.logger.warn(
                 'Did not find remote heads for {0}'.format(project_name))
 
-    def project_is_valid(self, project_name):
-        return True if project_name in self.projects.keys() else False
+    def project_is_valid(self, project_name, project_type=None):
+        ''' True if the project is watched, as one of that type if given
+
+            a name that fits a pattern of another type does not add a project
+        '''
+        lookup = getattr(self.projects, 'lookup', None)
+        data = lookup(project_name, project_type) if lookup else self.projects.get(project_name)
+        return data is not None and project_type in (None, data['type'])
 
     def _do_handle_one_event(self):
         ''' Handles an event off the queue '''
         event = self.queue.get(True, 2)
+        started = time()
+        self.busy = True
+        if 'received' in event:
+            METRICS.observe('repowatch_event_wait_seconds', started - event['received'], type=event['type'])
+        METRICS.inc('repowatch_workers_busy')
+        try:
+            with trace(event), span('event',
+                                    type=event['type'],
+                                    project=event.get('project_name'),
+                                    branch=event.get('output_dir') or event.get('branch_name'),
+                                    wait=round(started - event.get('received', started), 6)):
+                self.handle_event(event)
+        finally:
+            self.busy = False
+            self.queue.done(event)
+            METRICS.inc('repowatch_workers_busy', -1)
+            METRICS.inc('repowatch_worker_busy_seconds_total', time() - started)
+            if 'received' in event:
+                METRICS.observe('repowatch_event_age_seconds', time() - event['received'], type=event['type'])
 
+    def handle_event(self, event):
         if event['type'] == 'shutdown':
             raise StopException
 
-        if not self.project_is_valid(event['project_name']):
-            self.logger.error('Not a valid project name: '.format(event['project_name']))
+        if not self.project_is_valid(event['project_name'], event.get('project_type')):
+            self.logger.error('Not a valid project name: {0}'.format(event['project_name']))
             return
 
         if event['type'] == 'update':
-            del event['type']
-            self.update_branch(**event)
-        elif event['type'] == 'delete':
-            # cleanup old branches on every event process
+            self.update_branch(event['project_name'],
+                               event['branch_name'],
+                               event.get('output_dir'),
+                               event.get('sha'))
+        elif event['type'] == 'delete' and event.get('branch_name'):
+            self.delete_branch(event['project_name'], event['branch_name'])
+        elif event['type'] in ('delete', 'reconcile'):
             self.cleanup_old_branches(event['project_name'])
-            del event['type']
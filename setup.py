@@ -14,5 +14,6 @@ setup(name='repowatch',
       license='MIT',
       packages=['repowatch'],
       install_requires=deps,
+      extras_require={'dulwich': ['dulwich']},
       tests_require=deps,
       entry_points={'console_scripts': ['repowatch=repowatch.cli:cli']})
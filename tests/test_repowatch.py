@@ -1,4 +1,28 @@
+import os
+import json
+import socket
+import httplib
+import calendar
+import threading
+from Queue import Empty, Full
+from time import time, sleep, strptime
+
+import pytest
+
 import repowatch
+from repowatch import worker, gitbackend, trace
+from repowatch.matcher import ProjectIndex
+from repowatch.eventqueue import CoalescingQueue, BULK
+from repowatch.state import BranchState
+from repowatch.reconcile import Trash, TRASH_PREFIX
+from repowatch.metrics import Metrics, METRICS
+from repowatch.executor import CommandExecutor
+from repowatch.journal import Journal
+from repowatch.scaler import WorkerScaler
+from repowatch.gitlab import GitlabHTTPServer, GitlabHTTPHandler
+from repowatch.cluster import HashRing, LocalCoordinator, FileCoordinator, Cluster, ClusterServer, Router, \
+    TOKEN_HEADER
+from repowatch.util import get_remote_heads, run_cmd, create_ssh_wrapper, HostSlots
 
 
 CONFIG_CONF = '''
@@ -25,6 +49,26 @@ PROJECT_YAML = '''
 '''
 
 
+def commit(repo, files):
+    ''' Write files {name: content} into repo, made a repository first if needed, and commit, returns the sha '''
+    for name, content in files.items():
+        repo.join(name).write(content, ensure=True)
+    if not repo.join('.git').exists():
+        for cmd in ('git init -q', 'git config uploadpack.allowfilter true'):
+            assert run_cmd(cmd, None, cwd=str(repo)) is not False
+    for cmd in ('git add -A', 'git -c user.name=t -c user.email=t@t commit -qm update'):
+        assert run_cmd(cmd, None, cwd=str(repo)) is not False
+    return run_cmd('git rev-parse HEAD', None, cwd=str(repo))
+
+
+@pytest.fixture
+def upstream(tmpdir):
+    ''' Repository with file committed on master, see commit() for more '''
+    repo = tmpdir.join('upstream')
+    commit(repo, {'file': 'x'})
+    return repo
+
+
 def test_simple_import(tmpdir):
     cfg = tmpdir.join('config_test.conf')
     cfg.write(CONFIG_CONF)
@@ -38,3 +82,827 @@ def test_simple_import(tmpdir):
                              False,
                              True)
     rw.setup()
+
+
+def test_reload_adds_and_removes_projects(tmpdir, monkeypatch):
+    cfg = tmpdir.join('config_test.conf')
+    cfg.write(CONFIG_CONF)
+    proj = tmpdir.join('project_test.yaml')
+    proj.write(PROJECT_YAML)
+
+    rw = repowatch.RepoWatch(str(cfg), str(proj), False, False, True)
+    rw.setup()
+    checked_out = []
+    monkeypatch.setattr(rw, '_initial_checkout', checked_out.extend)
+    rw.queue.put({'type': 'update', 'project_name': 'test-project', 'branch_name': 'master'})
+    gerrit, workers = rw.threads['gerrit'], rw.worker_threads
+
+    proj.write(PROJECT_YAML.replace('- project: test-project\n', '- project: new-project\n'))
+    rw.reload()
+    rw.threads['reload-discovery'].join()
+
+    assert sorted(rw.projects) == ['new-project', 'testuser/test-project']
+    assert rw.queue.empty() and checked_out == ['new-project']
+    assert rw.threads['gerrit'] is gerrit and rw.worker_threads == workers
+    rw.queue.put({'type': 'update', 'project_name': 'test-project', 'branch_name': 'master'})
+    assert rw.queue.empty()
+
+
+def test_reload_drains_in_the_background_and_rebuilds_the_lock(tmpdir, monkeypatch):
+    cfg = tmpdir.join('config_test.conf')
+    cfg.write(CONFIG_CONF)
+    proj = tmpdir.join('project_test.yaml')
+    proj.write(PROJECT_YAML)
+    monkeypatch.setattr(repowatch.WatchGerrit, 'run', lambda self: None)
+    rw = repowatch.RepoWatch(str(cfg), str(proj), False, False, True)
+    rw.setup()
+    rw.threads['gerrit'].start()
+    monkeypatch.setattr(rw, '_initial_checkout', lambda names: None)
+    rw.queue.put({'type': 'update', 'project_name': 'test-project', 'branch_name': 'master'})
+    running = rw.queue.get(False)
+
+    proj.write(PROJECT_YAML.replace('- project: test-project\n', '- project: new-project\n'))
+    cfg.write(CONFIG_CONF.replace('[gerrit]', '[gerrit]\nsequential_project_commands = true'))
+    started = time()
+    rw.reload()
+    assert time() - started < 5
+    assert rw.project_lock('test-project') is rw.project_lock('test-project')
+    assert not isinstance(rw.project_lock('test-project'), repowatch.NoLock)
+    # another reload waits for the removed project to finish
+    rw.request_reload()
+    rw.reload()
+    assert rw.reload_requested and 'test-project' in rw.projects.keys()
+
+    rw.queue.done(running)
+    rw.threads['reload-discovery'].join(10)
+    assert sorted(rw.projects) == ['new-project', 'testuser/test-project']
+
+
+def test_project_patterns(tmpdir):
+    cfg = tmpdir.join('config_test.conf')
+    cfg.write(CONFIG_CONF)
+    proj = tmpdir.join('project_test.yaml')
+    proj.write(PROJECT_YAML + '''
+- project: group/docs
+  type: gitlab
+  path: /srv/docs
+- project: group/*
+  type: gitlab
+  path: /srv/{name}
+- regex: 'team-[0-9]+/.*'
+  type: gerrit
+  path: /srv/teams/{project}
+''')
+    projects = repowatch.RepoWatch(str(cfg), str(proj), False, False, True).read_projects()
+    assert sorted(projects) == ['group/docs', 'test-project', 'testuser/test-project']
+
+    assert projects['group/docs']['path'] == '/srv/docs'
+    assert projects['group/new']['path'] == '/srv/new' and projects['group/new']['type'] == 'gitlab'
+    assert 'team-7/a/b' in projects and projects['team-7/a/b']['path'] == '/srv/teams/team-7/a/b'
+    assert 'team-x/a' not in projects and 'other/new' not in projects
+    assert projects.lookup('group/x', 'gerrit') is None
+    # found projects are kept like listed ones
+    assert sorted(projects) == ['group/docs', 'group/new', 'team-7/a/b', 'test-project', 'testuser/test-project']
+    assert projects.types() == set(['gerrit', 'gitlab'])
+
+    # workers add projects found by patterns while the main thread iterates
+    adding = threading.Thread(target=lambda: [projects.lookup('group/p{0}'.format(i)) for i in range(5000)])
+    adding.start()
+    while adding.is_alive():
+        for _ in projects:
+            sleep(0)
+    assert len(projects) == 5005
+
+
+def test_queue_coalesces_branch_events():
+    queue = CoalescingQueue()
+    for _ in range(20):
+        queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master'})
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'devel'})
+    queue.put({'type': 'delete', 'project_name': 'p', 'branch_name': 'devel'})
+    queue.put({'type': 'shutdown'})
+
+    assert queue.qsize() == 3
+    assert queue.merged == 20
+    assert queue.get(False)['branch_name'] == 'master'
+    assert queue.get(False)['type'] == 'delete'
+    assert queue.get(False)['type'] == 'shutdown'
+    with pytest.raises(Empty):
+        queue.get(True, 0.01)
+
+
+def test_queue_serializes_branch_work():
+    queue = CoalescingQueue()
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master'})
+    first = queue.get(False)
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master'})
+    queue.put({'type': 'delete', 'project_name': 'p'})
+    queue.put({'type': 'update', 'project_name': 'q', 'branch_name': 'master'})
+
+    # same branch and the project cleanup wait, other projects do not
+    assert queue.get(False)['project_name'] == 'q'
+    with pytest.raises(Empty):
+        queue.get(False)
+
+    queue.done(first)
+    assert queue.get(False)['branch_name'] == 'master'
+
+
+def test_queue_cleanup_is_not_starved_by_branch_traffic():
+    queue = CoalescingQueue()
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'b0'})
+    working = queue.get(False)
+    queue.put({'type': 'delete', 'project_name': 'p'})
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'b1'})
+    queue.put({'type': 'update', 'project_name': 'q', 'branch_name': 'master'})
+
+    # new branch work of the project waits behind the cleanup, other projects do not
+    assert queue.get(False)['project_name'] == 'q'
+    with pytest.raises(Empty):
+        queue.get(False)
+
+    queue.done(working)
+    cleanup = queue.get(False)
+    assert cleanup['type'] == 'delete'
+    with pytest.raises(Empty):
+        queue.get(False)
+    queue.done(cleanup)
+    assert queue.get(False)['branch_name'] == 'b1'
+
+
+def test_queue_live_lane_first_with_fair_share():
+    queue = CoalescingQueue(bulk_every=3)
+    for i in range(4):
+        queue.put({'type': 'update', 'project_name': 'bulk', 'branch_name': str(i), 'lane': BULK})
+    for i in range(4):
+        queue.put({'type': 'update', 'project_name': 'live', 'branch_name': str(i)})
+    # a live event for waiting bulk work moves it up
+    queue.put({'type': 'update', 'project_name': 'bulk', 'branch_name': '3'})
+
+    order = [queue.get(False) for _ in range(8)]
+    assert [(e['project_name'], e['branch_name']) for e in order] == [
+        ('live', '0'), ('live', '1'), ('bulk', '0'), ('live', '2'),
+        ('live', '3'), ('bulk', '1'), ('bulk', '3'), ('bulk', '2')]
+    assert queue.empty()
+
+
+def test_journal_replays_unfinished_events(tmpdir):
+    path = str(tmpdir.join('journal'))
+    queue = CoalescingQueue()
+    queue.journal = Journal(path, compact_at=2)
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'done'})
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'merged', 'sha': '1'})
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'merged', 'sha': '2'})
+    queue.put({'type': 'reconcile', 'project_name': 'p', 'lane': BULK})
+    queue.put({'type': 'shutdown'})
+    queue.done(queue.get(False))
+    queue.journal.sync()
+    for sha in range(3):
+        queue.put({'type': 'update', 'project_name': 'q', 'branch_name': 'master', 'sha': sha})
+    queue.journal.sync()
+    # compacted down to what is unfinished
+    assert len(tmpdir.join('journal').readlines()) == 3
+
+    events = Journal(path).load()
+    updates = [(e['branch_name'], e['sha']) for e in events if e['type'] == 'update']
+    assert updates == [('merged', '2'), ('master', 2)]
+    assert [e['lane'] for e in events if e['type'] == 'reconcile'] == [BULK]
+    # still in the file until they are queued again and done
+    assert len(Journal(path).load()) == 3
+
+
+def test_journal_sync_does_not_hold_up_the_queue(tmpdir, monkeypatch):
+    queue = CoalescingQueue()
+    queue.journal = Journal(str(tmpdir.join('journal')), compact_at=0)
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master'})
+    syncing = threading.Event()
+    release = threading.Event()
+
+    def slow_fsync(fd):
+        syncing.set()
+        release.wait(10)
+
+    monkeypatch.setattr(repowatch.journal.os, 'fsync', slow_fsync)
+    sync = threading.Thread(target=queue.journal.sync)
+    sync.start()
+    assert syncing.wait(5)
+    started = time()
+    queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'other'})
+    queue.done(queue.get(False))
+    assert time() - started < 1
+    release.set()
+    sync.join(5)
+
+
+def test_cluster_moves_few_projects_and_routes_events(tmpdir):
+    projects = ['group/project{0}'.format(i) for i in range(300)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [p for p in projects if before.owner(p) != after.owner(p)]
+    # only projects going to the new node move
+    assert all(after.owner(p) == 'd' for p in moved) and 40 < len(moved) < 120
+
+    coordinator = FileCoordinator(str(tmpdir.join('cluster')))
+    queue = CoalescingQueue()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    other = Cluster(coordinator, 'b', '127.0.0.1:{0}'.format(port))
+    here = Cluster(coordinator, 'a', '127.0.0.1:1')
+    server = ClusterServer('127.0.0.1', port, queue, 'secret', other.owns)
+    server.daemon = True
+    server.start()
+    for node in (other, here, other):
+        node.join_cluster()
+    assert sorted(here.members) == ['a', 'b'] and here.is_leader() and not other.is_leader()
+
+    project = next(p for p in projects if not here.owns(p))
+    with pytest.raises(Full):
+        Router(here, CoalescingQueue(), 'wrong').put({'type': 'update', 'project_name': project})
+    Router(here, CoalescingQueue(), 'secret').put({'type': 'update', 'project_name': project, 'branch_name': 'master'})
+    assert queue.get(True, 5)['project_name'] == project
+
+    def post(event):
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('POST', '/event', json.dumps(event), {TOKEN_HEADER: 'secret'})
+        return connection.getresponse().status
+
+    assert post({'type': 'shutdown'}) == 400
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+    connection.putrequest('POST', '/event')
+    connection.putheader(TOKEN_HEADER, 'secret')
+    connection.putheader('Content-Length', '-1')
+    connection.endheaders()
+    assert connection.getresponse().status == 400
+    assert post({'type': 'delete', 'project_name': project, 'branch_name': '../../etc'}) == 400
+    assert post({'type': 'update', 'project_name': project, 'branch_name': 'x', 'output_dir': '/tmp'}) == 400
+    assert post({'type': 'update', 'project_name': next(p for p in projects if here.owns(p))}) == 409
+    assert queue.qsize() == 0
+    server.running = False
+    other.leave()
+    here.join_cluster()
+    assert here.owns(project)
+
+
+def test_cluster_settles_before_owning():
+    coordinator = LocalCoordinator(ttl=3)
+    here = Cluster(coordinator, 'a', '127.0.0.1:1')
+    # the other node writes its first heartbeat a little after we start
+    threading.Timer(0.2, coordinator.heartbeat, ('b', '127.0.0.1:2')).start()
+    here.settle()
+    assert sorted(here.members) == ['a', 'b']
+
+
+def test_scaler_grows_with_backlog_and_shrinks_when_idle(monkeypatch):
+    queue = CoalescingQueue()
+    counts = {'gerrit': 1, 'gitlab': 4}
+
+    def resize(section, n):
+        counts[section] += n
+
+    scaler = WorkerScaler(queue, counts, lambda: {'gerrit': (1, 3), 'gitlab': (1, 4)}, resize,
+                          up_age=10, idle_time=0)
+    monkeypatch.setattr(scaler, 'load', lambda: 0.5)
+    for i in range(20):
+        queue.put({'type': 'update', 'project_name': 'p', 'branch_name': str(i)})
+    scaler.step()
+    assert counts == {'gerrit': 1, 'gitlab': 4}
+
+    monkeypatch.setattr(queue, 'oldest_age', lambda: 30)
+    monkeypatch.setattr(scaler, 'load', lambda: 5.0)
+    scaler.step()
+    assert counts == {'gerrit': 1, 'gitlab': 4}
+    monkeypatch.setattr(scaler, 'load', lambda: 0.5)
+    scaler.step()
+    # bounded by the largest size of each section
+    assert counts == {'gerrit': 3, 'gitlab': 4}
+
+    while not queue.empty():
+        queue.done(queue.get(False))
+    scaler.step()
+    scaler.step()
+    assert counts == {'gerrit': 2, 'gitlab': 2}
+    for _ in range(5):
+        scaler.step()
+    assert counts == {'gerrit': 1, 'gitlab': 1}
+
+
+def test_scale_down_stops_idle_workers_of_the_section(tmpdir):
+    cfg = tmpdir.join('config_test.conf')
+    cfg.write(CONFIG_CONF.replace('[gitlab]', '[gitlab]\nthreads = 3\nsequential_project_commands = true'))
+    proj = tmpdir.join('project_test.yaml')
+    proj.write(PROJECT_YAML)
+    rw = repowatch.RepoWatch(str(cfg), str(proj), False, False, True)
+    rw.setup()
+    gitlab = sorted((t for t in rw.threads.values() if isinstance(t, worker.Worker) and t.section_name == 'gitlab'),
+                    key=lambda t: t.name)
+    gitlab[0].busy = True
+
+    rw.start_workers('gitlab', -2)
+    assert [t.running for t in gitlab] == [True, False, False]
+    assert all(t.running for t in rw.threads.values() if isinstance(t, worker.Worker) and t.section_name == 'gerrit')
+    assert rw.section_threads['gitlab'] == 1
+    # the lock follows the section of the project, not of the worker
+    assert rw.project_lock('testuser/test-project') is rw.project_lock('testuser/test-project')
+    assert isinstance(rw.project_lock('test-project'), repowatch.NoLock)
+
+
+def test_ssh_wrapper_starts_the_master_on_its_own(tmpdir, monkeypatch):
+    calls = tmpdir.join('calls')
+    fake = tmpdir.join('bin', 'ssh')
+    # a master that keeps running, with the stderr it was given
+    fake.write('#!/bin/sh\n'
+               'echo "$@" >> {0}\n'
+               'case "$*" in\n'
+               '    *"-O check"*) [ -e {1} ] ;;\n'
+               '    *-Nf*) touch {1}; sleep 5 & ;;\n'
+               '    *) echo remote ;;\n'
+               'esac\n'.format(calls, tmpdir.join('master')), ensure=True)
+    fake.chmod(0o755)
+    monkeypatch.setenv('PATH', '{0}:{1}'.format(fake.dirname, os.environ['PATH']))
+    control_dir = tmpdir.mkdir('control')
+    wrapper = create_ssh_wrapper(str(control_dir), 30)
+
+    for _ in range(2):
+        started = time()
+        assert run_cmd('{0} -p 29418 git@host git-upload-pack'.format(wrapper), None, ssh_key='/key') == 'remote'
+        assert time() - started < 3
+    path = '-oControlPath={0}/%r@%h:%p'.format(control_dir)
+    args = '-oStrictHostKeyChecking=no -i /key -p 29418 git@host git-upload-pack'
+    assert calls.read().splitlines() == [
+        path + ' -O check ' + args,
+        path + ' -O check ' + args,
+        path + ' -oControlMaster=yes -oControlPersist=30 -Nf ' + args,
+        path + ' -oControlMaster=no ' + args,
+        path + ' -O check ' + args,
+        path + ' -oControlMaster=no ' + args]
+    os.unlink(wrapper)
+
+
+def test_host_budget_caps_operations_per_host(monkeypatch):
+    monkeypatch.setattr(worker, 'HOST_BUDGET', HostSlots(2))
+    options = {'gitlab': {'hostname': 'a'}, 'gerrit': {'hostname': 'b'}}
+    projects = {'p': {'type': 'gitlab', 'path': '/p'}, 'q': {'type': 'gerrit', 'path': '/q'}}
+    w = worker.Worker(options, None, None, projects, repowatch.NoLock())
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    most = {'a': 0, 'b': 0}
+
+    def operation(project, host):
+        with w.remote(project):
+            with lock:
+                running[host] += 1
+                most[host] = max(most[host], running[host])
+            sleep(0.05)
+            with lock:
+                running[host] -= 1
+
+    threads = [threading.Thread(target=operation, args=args) for args in [('p', 'a'), ('q', 'b')] * 5]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert most == {'a': 2, 'b': 2}
+
+
+def test_discovery_caches_host_keys_and_caps_hosts(tmpdir, monkeypatch):
+    rw = repowatch.RepoWatch(None, None, False, False, True)
+    checked = []
+    monkeypatch.setattr(repowatch, 'run_cmd', lambda cmd, wrapper: checked.append(cmd) or 'found')
+    assert rw._host_key_known('a') and rw._host_key_known('a') and rw._host_key_known('b')
+    assert len(checked) == 2
+
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    most = {'a': 0, 'b': 0}
+
+    class Backend(object):
+        def __init__(self, host):
+            self.host = host
+
+        def ls_remote(self, url):
+            with lock:
+                running[self.host] += 1
+                most[self.host] = max(most[self.host], running[self.host])
+            sleep(0.05)
+            with lock:
+                running[self.host] -= 1
+            return [('master', 'a' * 40)]
+
+    class Watcher(object):
+        def get_extra(self, projects):
+            return []
+
+    class Reconciler(object):
+        def request(self, project):
+            pass
+
+    rw.projects = ProjectIndex(('{0}/{1}'.format(section, i), {'type': section, 'path': '/p'})
+                               for section in ('gitlab', 'gerrit') for i in range(6))
+    rw.options = {'gitlab': {'hostname': 'a'}, 'gerrit': {'hostname': 'b'}}
+    rw.backends = {'gitlab': Backend('a'), 'gerrit': Backend('b')}
+    rw.threads = {'gitlab': Watcher(), 'gerrit': Watcher()}
+    rw.reconciler = Reconciler()
+    rw.settings = {'discovery_threads': '12'}
+    rw.discovery_slots = HostSlots(2)
+    rw._initial_checkout(list(rw.projects))
+
+    assert most == {'a': 2, 'b': 2} and rw.queue.qsize() == 12
+    assert len(checked) == 2
+
+
+def test_update_skipped_when_head_matches(tmpdir, monkeypatch):
+    sha = 'a' * 40
+    tmpdir.join('master', '.git', 'HEAD').write(sha + '\n', ensure=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('ran {0}'.format(args))
+    monkeypatch.setattr(gitbackend, 'run_cmd', fail)
+
+    projects = {'p': {'type': 'gitlab', 'path': str(tmpdir)}}
+    w = worker.Worker({'gitlab': {}}, None, None, projects, repowatch.NoLock())
+    w.update_branch('p', 'master', sha=sha)
+
+    heads = get_remote_heads('{0}\trefs/heads/master\n{1}\trefs/heads/devel\n'.format(sha, 'b' * 40))
+    assert heads == [('master', sha), ('devel', 'b' * 40)]
+
+
+def test_executor_runs_newest_commands_with_timeout(tmpdir):
+    executor = CommandExecutor(lambda project: 1)
+    for i in range(3):
+        executor.submit('p', 'master', 'master', ['touch {0}'.format(i)], str(tmpdir), str(tmpdir))
+    executor.cancel('p', 'devel')
+    executor.run_one(False)
+    with pytest.raises(Empty):
+        executor.run_one(False)
+    assert [p.basename for p in tmpdir.listdir()] == ['2']
+
+    start = time()
+    assert run_cmd('sleep 10', None, timeout=0.2) is False
+    assert time() - start < 5
+
+
+def test_dulwich_backend_fetches_branch(tmpdir, upstream):
+    pytest.importorskip('dulwich')
+    sha = run_cmd('git rev-parse HEAD', None, cwd=str(upstream))
+
+    git = gitbackend.DulwichGit(None)
+    url = 'file://' + str(upstream)
+    assert git.ls_remote(url) == [('master', sha)]
+
+    checkout = tmpdir.join('checkout').ensure(dir=True)
+    git.init(str(checkout))
+    assert git.fetch(str(checkout), url, 'master', depth=1)
+    assert git.checkout(str(checkout))
+    assert checkout.join('file').read() == 'x'
+    assert not git.fetch(str(checkout), url, 'missing')
+
+
+def test_atomic_publish_swaps_symlink(tmpdir, upstream):
+    commit(upstream, {'same': 'same', 'changed': 'old'})
+
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream), 'atomic_publish': 'True'}
+    projects = {'p': {'type': 'gitlab', 'path': str(tmpdir.join('check outs'))}}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock())
+    w.update_branch('p', 'master')
+    published = tmpdir.join('check outs', 'master')
+    first = published.realpath()
+    assert published.islink() and published.join('changed').read() == 'old'
+    published.join('build.log').write('one')
+    fetch_head = first.join('.git', 'FETCH_HEAD').read()
+
+    commit(upstream, {'changed': 'new'})
+    w.update_branch('p', 'master')
+    # readers of the old checkout still see it whole, unchanged files are shared
+    assert published.join('changed').read() == 'new' and first.join('changed').read() == 'old'
+    assert published.join('same').stat().ino == first.join('same').stat().ino
+    # what git and commands write in place is not shared
+    published.join('build.log').write('two')
+    assert first.join('build.log').read() == 'one' and first.join('.git', 'FETCH_HEAD').read() == fetch_head
+
+    w.update_branch('p', 'master')
+    w.update_branch('p', 'master')
+    generations = tmpdir.join('check outs', worker.GENERATIONS, 'master').listdir()
+    assert len(generations) == worker.DEFAULT_PUBLISH_KEEP and first not in generations
+
+
+def test_mirror_objects_are_shared_by_branches(tmpdir, upstream):
+    assert run_cmd('git checkout -q -b dev', None, cwd=str(upstream)) is not False
+    commit(upstream, {'dev': 'y'})
+
+    mirrors = tmpdir.join('mirrors')
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream), 'mirror_dir': str(mirrors)}
+    projects = {'p': {'type': 'gitlab', 'path': str(tmpdir.join('checkouts'))}}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock())
+    for branch in ('master', 'dev'):
+        w.update_branch('p', branch)
+
+    for branch in ('master', 'dev'):
+        checkout = tmpdir.join('checkouts', branch)
+        objects = checkout.join('.git', 'objects')
+        assert objects.join('info', 'alternates').read().split() == [str(mirrors.join('p.git', 'objects'))]
+        # everything comes from the mirror, nothing is fetched into the branch
+        assert [d.basename for d in objects.listdir() if d.basename not in ('info', 'pack')] == []
+        assert objects.join('pack').listdir() == []
+    assert tmpdir.join('checkouts', 'master', 'file').read() == 'x'
+    assert tmpdir.join('checkouts', 'dev', 'dev').read() == 'y'
+
+
+@pytest.mark.parametrize('mirror', [False, True])
+def test_partial_sparse_checkout(tmpdir, upstream, mirror):
+    commit(upstream, {'wanted/file': 'x', 'other/file': 'y'})
+
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream)}
+    if mirror:
+        options['mirror_dir'] = str(tmpdir.join('mirrors'))
+    projects = {'p': {'type': 'gitlab', 'path': str(tmpdir.join('checkouts')),
+                      'filter': 'blob:none', 'sparse': ['/wanted/']}}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock())
+    w.update_branch('p', 'master')
+
+    checkout = tmpdir.join('checkouts', 'master')
+    assert checkout.join('wanted', 'file').read() == 'x'
+    assert not checkout.join('other').exists()
+    # the blob of other/file was never downloaded
+    blob = run_cmd('git rev-parse HEAD:other/file', None, cwd=str(checkout))
+    assert '?' + blob in run_cmd('git rev-list --objects --missing=print HEAD', None, cwd=str(checkout)).split()
+    # with a mirror too the checkout is a partial clone of the server
+    git = gitbackend.SubprocessGit(None)
+    assert [git.get_config(str(checkout), key) for key in ('core.repositoryformatversion', 'extensions.partialClone',
+                                                           'remote.origin.partialclonefilter')] == [
+        '1', 'origin', 'blob:none']
+    # it is there when the other files are wanted
+    projects['p']['sparse'] = None
+    w.update_branch('p', 'master')
+    assert checkout.join('other', 'file').read() == 'y'
+
+
+def test_fetch_once_for_every_destination(tmpdir, upstream, monkeypatch):
+    cfg = tmpdir.join('config_test.conf')
+    cfg.write(CONFIG_CONF)
+    proj = tmpdir.join('project_test.yaml')
+    proj.write('''
+- {{project: p, type: gitlab, path: {0}/build}}
+- {{project: p, type: gitlab, path: {0}/docs, cmds: ['touch %{{branchdir}}/.built'], sparse: [/file]}}
+'''.format(tmpdir))
+    projects = repowatch.RepoWatch(str(cfg), str(proj), False, False, True).read_projects()
+    assert [d['path'] for d in projects['p']['destinations']] == [str(tmpdir.join('docs'))]
+
+    fetched = []
+    fetch = gitbackend.SubprocessGit.fetch
+    monkeypatch.setattr(gitbackend.SubprocessGit, 'fetch', lambda self, path, url, *args, **kwargs:
+                        fetched.append(url) or fetch(self, path, url, *args, **kwargs))
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream)}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock())
+    w.update_branch('p', 'master')
+
+    assert tmpdir.join('build', 'master', 'file').read() == tmpdir.join('docs', 'master', 'file').read() == 'x'
+    assert tmpdir.join('docs', 'master', '.built').exists()
+    assert not tmpdir.join('build', 'master', '.built').exists()
+    assert [url for url in fetched if url.startswith('file://')] == ['file://' + str(upstream)]
+
+
+def test_trace_spans_share_event_trace_id(tmpdir, upstream):
+    trace_file = tmpdir.join('trace.json')
+    trace.enable(str(trace_file))
+    try:
+        queue = CoalescingQueue()
+        options = {'hostname': 'localhost', 'url': 'file://' + str(upstream)}
+        projects = {'p': {'type': 'gitlab', 'path': str(tmpdir.join('checkouts'))}}
+        w = worker.Worker({'gitlab': options}, queue, None, projects, repowatch.NoLock())
+        queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master', 'trace_id': 'first'})
+        queue.put({'type': 'update', 'project_name': 'p', 'branch_name': 'master', 'trace_id': 'second'})
+        w._do_handle_one_event()
+    finally:
+        for handler in list(trace.LOG.handlers):
+            trace.LOG.removeHandler(handler)
+            handler.close()
+
+    spans = [json.loads(line) for line in trace_file.readlines()]
+    assert [(s['trace_id'], s['merged_into']) for s in spans if s['span'] == 'merged'] == [('first', 'second')]
+    names = set(s['span'] for s in spans if s['trace_id'] == 'second')
+    assert set(['event', 'fetch', 'run_cmd']) <= names
+    assert set(s['trace_id'] for s in spans if s['span'] != 'merged') == set(['second'])
+
+
+def test_branch_state(tmpdir):
+    state = BranchState(str(tmpdir.join('state')))
+    state.record('p', 'master', 'master', 'a' * 40, 'ok')
+    state.record('p', 'devel', 'devel', 'b' * 40, 'failed')
+
+    assert state.is_current('p', 'master', 'a' * 40)
+    assert not state.is_current('p', 'devel', 'b' * 40)
+    assert sorted(state.directories('p')) == ['devel', 'master']
+
+    state.remove('p', 'devel')
+    assert state.directories('p') == ['master']
+    state.close()
+
+
+def test_delete_moves_branch_to_trash(tmpdir):
+    tmpdir.join('master', 'file').write('x', ensure=True)
+    tmpdir.join('devel', 'file').write('x', ensure=True)
+
+    trash = Trash()
+    projects = {'p': {'type': 'gitlab', 'path': str(tmpdir)}}
+    w = worker.Worker({'gitlab': {}}, None, None, projects, repowatch.NoLock(), trash=trash)
+    w.handle_event({'type': 'delete', 'project_name': 'p', 'branch_name': 'devel'})
+
+    names = sorted(p.basename for p in tmpdir.listdir())
+    assert names[0].startswith(TRASH_PREFIX) and names[1] == 'master'
+    assert trash.queue.qsize() == 1
+
+
+def test_cleanup_finds_unrecorded_branches_and_trash(tmpdir, upstream):
+    checkouts = tmpdir.join('checkouts')
+    for name in ('master', 'recorded-gone', 'unrecorded-gone', TRASH_PREFIX + 'left'):
+        checkouts.join(name, 'file').write('x', ensure=True)
+    state = BranchState(str(tmpdir.join('state')))
+    state.record('p', 'recorded-gone', 'recorded-gone', 'a' * 40, 'ok')
+
+    trash = Trash()
+    # branches are listed from the url with .git added
+    tmpdir.join('upstream.git').mksymlinkto(upstream)
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream)}
+    projects = {'p': {'type': 'gitlab', 'path': str(checkouts)}}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock(), state, trash)
+    w.cleanup_old_branches('p')
+
+    assert [p.basename for p in checkouts.listdir() if not p.basename.startswith(TRASH_PREFIX)] == ['master']
+    # two deleted branches and the left over trash
+    assert trash.queue.qsize() == 3
+    assert state.directories('p') == []
+
+
+def test_cleanup_looks_in_every_destination(tmpdir, upstream):
+    first, second = tmpdir.join('first'), tmpdir.join('second')
+    for directory in (first.join('master'), second.join('master'), second.join('gone')):
+        directory.join('file').write('x', ensure=True)
+    tmpdir.join('upstream.git').mksymlinkto(upstream)
+    options = {'hostname': 'localhost', 'url': 'file://' + str(upstream)}
+    projects = {'p': {'type': 'gitlab', 'path': str(first), 'destinations': [{'path': str(second)}]}}
+    w = worker.Worker({'gitlab': options}, None, None, projects, repowatch.NoLock())
+    w.cleanup_old_branches('p')
+
+    assert [d.basename for d in first.listdir()] == ['master']
+    assert [d.basename for d in second.listdir()] == ['master']
+
+
+def test_pattern_projects_keep_their_type_and_go_with_the_remote(tmpdir):
+    projects = ProjectIndex()
+    projects.add_pattern({'regex': 'team-[0-9]+/.*', 'type': 'gerrit', 'path': str(tmpdir) + '/{project}'})
+    options = {'hostname': 'localhost', 'url': 'file://' + str(tmpdir) + '/missing/{project}'}
+    w = worker.Worker({'gerrit': options, 'gitlab': options}, None, None, projects, repowatch.NoLock())
+    # a GitLab hook does not make a Gerrit project
+    w.handle_event({'type': 'update', 'project_name': 'team-1/a', 'branch_name': 'master', 'project_type': 'gitlab'})
+    assert projects.keys() == []
+    assert w.project_is_valid('team-1/a', 'gerrit') and projects.keys() == ['team-1/a']
+
+    w.cleanup_old_branches('team-1/a')
+    assert projects.keys() == []
+
+
+def test_gerrit_catch_up_pages(monkeypatch):
+    pages = [['{"project": "p", "number": 1, "status": "NEW", "branch": "master",'
+              ' "currentPatchSet": {"ref": "refs/changes/01/1/2", "revision": "' + 'a' * 40 + '"}}',
+              '{"type": "stats", "rowCount": 1, "moreChanges": true}'],
+             ['{"project": "p", "number": 2, "status": "MERGED", "branch": "master"}',
+              '{"type": "stats", "rowCount": 1, "moreChanges": false}']]
+    commands = []
+
+    class Client(object):
+        def exec_command(self, command):
+            commands.append(command)
+            return None, pages[len(commands) - 1], None
+
+    queue = CoalescingQueue()
+    watcher = repowatch.WatchGerrit({'port': '29418'}, queue)
+    watcher.catch_up(Client(), 1500000000)
+
+    assert '--start 1' in commands[1]
+    events = [queue.get(False) for _ in range(queue.qsize())]
+    assert [(e['type'], e.get('output_dir') or e['branch_name']) for e in events] == [
+        ('update', 'change_1'), ('delete', 'change_2'), ('update', 'master')]
+
+
+def test_gitlab_server_answers():
+    queue = CoalescingQueue(maxsize=1)
+    httpd = GitlabHTTPServer(('127.0.0.1', 0), GitlabHTTPHandler, queue, max_body=200, queue_timeout=0.1)
+    server = threading.Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+    port = httpd.server_address[1]
+
+    def hook(branch):
+        return json.dumps({'project': {'path_with_namespace': 'g/p'}, 'ref': 'refs/heads/' + branch,
+                           'after': 'a' * 40})
+
+    try:
+        # several deliveries on one connection
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('POST', '/', hook('a'))
+        assert connection.getresponse().read() == 'OK'
+        sock = connection.sock
+        connection.request('POST', '/', hook('b'))
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 503 and response.getheader('Retry-After') == '30'
+        connection.request('POST', '/', '{')
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 400 and connection.sock is sock
+        assert queue.get(False)['branch_name'] == 'a' and queue.qsize() == 0
+
+        connection.request('POST', '/', 'x' * 201)
+        assert connection.getresponse().status == 413
+        connection.close()
+
+        connection.putrequest('POST', '/')
+        connection.endheaders()
+        assert connection.getresponse().status == 411
+        connection.close()
+
+        connection.putrequest('POST', '/')
+        connection.putheader('Content-Length', '-1')
+        connection.endheaders()
+        assert connection.getresponse().status == 400
+        connection.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_gerrit_standby_catches_up_from_before_the_leader_died(monkeypatch):
+    monkeypatch.setattr(repowatch.gerrit, 'STANDBY_CHECK', 0)
+    watcher = repowatch.WatchGerrit({'port': '29418'}, CoalescingQueue())
+    # the leader is gone after the first look
+    watcher.active = lambda leader=iter([False]): next(leader, True)
+    watcher.takeover_lag = 30
+    commands = []
+
+    class Client(object):
+        def get_transport(self):
+            return self
+
+        def set_keepalive(self, interval):
+            pass
+
+        def close(self):
+            pass
+
+        def exec_command(self, command):
+            commands.append(command)
+            watcher.running = False
+            return None, [], None
+
+    monkeypatch.setattr(watcher, 'connect', Client)
+    started = time()
+    watcher.run()
+
+    assert commands[0] == 'gerrit stream-events'
+    stamp = commands[1].split('after:"')[1][:len('2000-01-01 00:00:00')]
+    since = calendar.timegm(strptime(stamp, '%Y-%m-%d %H:%M:%S'))
+    assert since <= started - 30 - repowatch.gerrit.CATCH_UP_OVERLAP
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.describe('x_seconds', 'histogram', 'Example')
+    metrics.observe('x_seconds', 0.3, project='p')
+    metrics.inc('y_total', command='git fetch')
+    metrics.set_function('z', lambda: 3)
+
+    lines = metrics.render().splitlines()
+    assert '# TYPE x_seconds histogram' in lines
+    assert 'x_seconds_bucket{project="p",le="0.25"} 0' in lines
+    assert 'x_seconds_bucket{project="p",le="+Inf"} 1' in lines
+    assert 'y_total{command="git fetch"} 1' in lines
+    assert 'z 3' in lines
+
+
+def test_metrics_scrape_while_putting():
+    queue = CoalescingQueue()
+    METRICS.set_function('test_queue_depth', queue.qsize)
+    counts = {'puts': 0, 'renders': 0}
+    end = time() + 0.5
+
+    def put():
+        while time() < end:
+            queue.put({'type': 'update', 'project_name': 'p', 'branch_name': str(counts['puts'] % 50)})
+            counts['puts'] += 1
+
+    def render():
+        while time() < end:
+            METRICS.render()
+            counts['renders'] += 1
+
+    threads = [threading.Thread(target=target) for target in (put, put, render)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    del METRICS.functions['test_queue_depth']
+    assert not any(thread.is_alive() for thread in threads)
+    assert counts['puts'] and counts['renders']